@@ -152,6 +152,17 @@ Handlers can also be defined inline using a similar syntax::
        return "".join(data.itervalues())
 
 
+To find out which parts of a program are recovering from errors, and what
+that recovery costs, enable the hot-spot profiler from withrestart.hotspots.
+It reports each code location that raised an error, with the number of errors,
+the restarts chosen for them and the time spent recovering, which covers both
+the handlers and the chosen restart::
+
+   withrestart.hotspots.enable()
+   ... run the program ...
+   print withrestart.hotspots.format_report()
+
+
 Now finally, a disclaimer.  I've never written any Common Lisp.  I've only read
 about the Common Lisp condition system and how awesome it is.  I'm sure there
 are many things that it can do that this module simply cannot.  For example:
@@ -159,27 +170,80 @@ are many things that it can do that this module simply cannot.  For example:
   * Since this is built on top of a standard exception-throwing system, the
     handlers can only be executed after the stack has been unwound to the
     most recent restart context; in Common Lisp they're executed without
-    unwinding the stack at all.
-  * Since this is built on top of a standard exception-throwing system, it's
-    probably too heavyweight to use for generic condition signalling system.
+    unwinding the stack at all.  The signal() and error() functions can be
+    used to run handlers at the site of an error, but this requires the
+    cooperation of the code that detects the error.
+  * Since this is built on top of a standard exception-throwing system,
+    raising errors is too heavyweight for generic condition signalling.  The
+    notify() and warn() functions can be used to signal conditions that are
+    not errors; they cost little more than a function call when none of the
+    established handlers match, but like signal() they need the cooperation
+    of the code raising them.
+  * Since this module is written for Python 2, there's no support for
+    asyncio: restarts and handlers can't be established with "async with",
+    and neither invoke() nor the handlers can be coroutines.  Work can be
+    moved off the current thread using withrestart.pool instead.
 
 Nevertheless, there's no shame in pinching a good idea when you see one...
 
 """
 
 __ver_major__ = 0
-__ver_minor__ = 2
-__ver_patch__ = 7
+__ver_minor__ = 3
+__ver_patch__ = 0
 __ver_sub__ = ""
 __version__ = "%d.%d.%d%s" % (__ver_major__,__ver_minor__,
                               __ver_patch__,__ver_sub__)
 
 
 import sys
+import warnings
+import threading
+import weakref
+
+from withrestart.callstack import CallStack, ContextCallStack, get_engine
+_cur_restarts = get_engine()()  # per-frame active restarts
+_cur_handlers = get_engine()()  # per-frame active handlers
+_handlers_generation = 0  # bumped when an established HandlerSuite changes
+_restarts_generation = 0  # bumped when an established RestartSuite changes
+_attempts = threading.local()  # attempt number of call being handled
+_profiler = None  # hot-spot profiler, see withrestart.hotspots
 
-from withrestart.callstack import CallStack
-_cur_restarts = CallStack()  # per-frame active restarts
-_cur_handlers = CallStack()  # per-frame active handlers
+#  Maximum number of attempts for retried calls; None means no limit.
+default_max_attempts = None
+
+#  Release the traceback of an error as soon as a restart is chosen for it,
+#  rather than keeping it until the restart has finished.
+lazy_tracebacks = False
+
+
+def set_callstack_engine(engine):
+    """Switch the CallStack engine used to track restarts and handlers.
+
+    The engine can be given as a class (e.g. CallStack or ContextCallStack)
+    or as the name of an engine from withrestart.callstack.ENGINES.  The
+    previous engine class is returned, so that it can later be restored.
+
+    This replaces the current stacks of restarts and handlers with fresh
+    empty ones, so it should not be called while any are established.
+    """
+    global _cur_restarts, _cur_handlers
+    if isinstance(engine,basestring):
+        engine = get_engine(engine)
+    old_engine = type(_cur_restarts)
+    _cur_restarts = engine()
+    _cur_handlers = engine()
+    return old_engine
+
+
+def callstack_stats():
+    """Get counts of the entries held by the restart and handler stacks.
+
+    This returns a dict with keys "restarts" and "handlers", each giving
+    the result of the stats() method of the corresponding stack.
+    """
+    return {"restarts": _cur_restarts.stats(),
+            "handlers": _cur_handlers.stats()}
 
 
 class RestartError(Exception):
@@ -188,8 +252,12 @@ class RestartError(Exception):
 
 
 class ControlFlowException(Exception):
-    """Base class for all control-flow exceptions used by this module."""
-    pass
+    """Base class for all control-flow exceptions used by this module.
+
+    These are raised often enough to make their size matter, so they use
+    __slots__ to avoid allocating an instance dict.
+    """
+    __slots__ = ()
 
 
 class MissingRestartError(RestartError):
@@ -200,6 +268,18 @@ class MissingRestartError(RestartError):
         return "No restart named '%s' has been defined" % (self.name,)
 
 
+class TooManyAttemptsError(RestartError):
+    """Exception raised when a call is retried too many times.
+
+    This is raised only if there is no underlying error to re-raise, e.g.
+    when the called function invoked the "retry" restart itself.
+    """
+    def __init__(self,max_attempts):
+        self.max_attempts = max_attempts
+    def __str__(self):
+        return "Call was retried more than %d times" % (self.max_attempts,)
+
+
 class InvokeRestart(ControlFlowException):
     """Exception raised by handlers to invoke a selected restart.
 
@@ -207,6 +287,8 @@ class InvokeRestart(ControlFlowException):
     code outside this module.  It's purposely not a sublcass of RestartError;
     you really shouldn't be catching it except under special circumstances.
     """
+    __slots__ = ("restart","kwds",)
+
     def __init__(self,restart,*args,**kwds):
         if not isinstance(restart,Restart):
             name = restart; restart = find_restart(name)
@@ -235,6 +317,8 @@ class ExitRestart(ControlFlowException):
     code outside this module.  It's purposely not a sublcass of RestartError;
     you really shouldn't be catching it except under special circumstances.
     """
+    __slots__ = ("restart",)
+
     def __init__(self,restart=None):
         self.restart = restart
 
@@ -251,7 +335,7 @@ class RetryLastCall(ControlFlowException):
     code outside this module.  It's purposely not a sublcass of RestartError;
     you really shouldn't be catching it except under special circumstances.
     """
-    pass
+    __slots__ = ()
 
 
 class RaiseNewError(ControlFlowException):
@@ -267,11 +351,18 @@ class RaiseNewError(ControlFlowException):
     code outside this module.  It's purposely not a sublcass of RestartError;
     you really shouldn't be catching it except under special circumstances.
     """
+    __slots__ = ("error",)
 
     def __init__(self,error):
         self.error = error
 
 
+#  Preallocated signals for the argument-free control-flow exceptions, so
+#  that the pre-defined "skip" and "retry" restarts don't need to create a
+#  new exception object every time they're invoked.
+_EXIT_RESTART = ExitRestart()
+_RETRY_LAST_CALL = RetryLastCall()
+
 
 class Restart(object):
     """Restart marker object.
@@ -286,6 +377,8 @@ class Restart(object):
     automatically wrap itself in a RestartSuite object.
     """
 
+    __slots__ = ("func","name","_exit_signal",)
+
     def __init__(self,func,name=None):
         """Restart object initializer.
 
@@ -299,28 +392,66 @@ class Restart(object):
             self.name = func.func_name
         else:
             self.name = name
+        self._exit_signal = None
 
     def invoke(self,*args,**kwds):
         """Invoke this restart with the given arguments.
 
         This wrapper method also maintains some internal state for use by
-        the restart-handling machinery.
+        the restart-handling machinery.  Any ExitRestart raised by the
+        restart function is replaced with one belonging to this restart,
+        which is created on first use and then reused; this avoids mutating
+        ExitRestart instances that might be shared between threads.
         """
         try:
             return self.func(*args,**kwds)
         except ExitRestart, e:
-            e.restart = self
-            raise
-
-    def __enter__(self):
+            if e.restart is self:
+                raise
+            signal = self._exit_signal
+            if signal is None:
+                signal = self._exit_signal = ExitRestart(self)
+            raise signal
+
+    def __enter__(self,offset=1):
+        #  The offset is the number of frames between this method and the
+        #  with-statement, which is greater than one if it's been wrapped.
         suite =  RestartSuite(self)
-        _cur_restarts.push(suite,1)
+        suite._established = True
+        _cur_restarts.push(suite,offset)
         return suite
 
     def __exit__(self,exc_type,exc_value,traceback):
         _cur_restarts.items().next().__exit__(exc_type,exc_value,traceback)
 
 
+def _normalise_error(error):
+    """Convert the error given to RaiseNewError into a sys.exc_info() tuple.
+
+    The error may be an exception instance or class, or a tuple of up to
+    three items in the same form as the arguments to a raise statement.
+    """
+    exc_type, exc_value, traceback = None, None, None
+    if isinstance(error,BaseException):
+        exc_type = type(error)
+        exc_value = error
+    elif isinstance(error,type):
+        exc_type = error
+        exc_value = error()
+    else:
+        values = tuple(error)
+        if len(values) == 1:
+            exc_type = values[0]
+            exc_info = exc_type()
+        elif len(values) == 2:
+            exc_type, exc_info = values
+        elif len(values) == 3:
+            exc_type, exc_value, traceback = values
+        else:
+            raise ValueError("too many items in exception tuple")
+    return exc_type, exc_value, traceback
+
+
 class RestartSuite(object):
     """Class holding a suite of restarts belonging to a common context.
 
@@ -332,13 +463,28 @@ class RestartSuite(object):
     If the attribute "default_handlers" is set to a Handler or HandlerSuite
     instance, that instance will be invoked if no other handler has been 
     established for the current exception type.
+
+    If the attribute "max_attempts" is set to an integer, functions invoked
+    via this suite will not be retried more than that many times in total.
+
+    Suites that are established over and over again, e.g. once for each
+    item in a loop, can be built once using the freeze() method and then
+    entered as many times as required.
     """
 
+    #  The '_established' flag is set once the suite has been entered,
+    #  after which modifying it must invalidate the cached results of
+    #  find_restart().  It is never cleared.
+    __slots__ = ("restarts","default_handlers","max_attempts",
+                 "_established",)
+
     def __init__(self,*restarts):
         self.restarts = []
         self.default_handlers = None
+        self.max_attempts = None
+        self._established = False
         for r in restarts:
-            if isinstance(r,RestartSuite):
+            if isinstance(r,(RestartSuite,FrozenRestartSuite,)):
                 for r2 in r.restarts:
                     self.restarts.append(r2)
             elif isinstance(r,Restart):
@@ -370,7 +516,10 @@ class RestartSuite(object):
                 r = func
             else:
                 r = Restart(func,name)
+            self._unshare_restarts()
             self.restarts.append(r)
+            if self._established:
+                _restarts_changed()
             return func
         if func is None:
             return do_add_restart
@@ -386,81 +535,136 @@ class RestartSuite(object):
         for r in self.restarts:
             if r is restart or r.func is restart or r.name == restart:
                 to_del.append(r)
+        self._unshare_restarts()
         for r in to_del:
             self.restarts.remove(r)
+        if self._established:
+            _restarts_changed()
+
+    def _unshare_restarts(self):
+        """Take a private copy of the restarts list before modifying it.
+
+        Suites entered from a FrozenRestartSuite share its tuple of restarts
+        until they are first modified.
+        """
+        if type(self.restarts) is tuple:
+            self.restarts = list(self.restarts)
+
+    def freeze(self):
+        """Get an immutable FrozenRestartSuite template of this suite."""
+        return FrozenRestartSuite(self)
 
     def __call__(self,func,*args,**kwds):
         """Invoke the given function in the context of this restart suite.
 
         If a restart is invoked in response to an error, its return value
-        is used in place of the function call.
+        is used in place of the function call.  If the restart asks for the
+        call to be retried, it is re-executed in a loop so that the call
+        stack does not grow with each attempt.  If the attribute
+        "max_attempts" (or failing that, the module-level variable
+        "default_max_attempts") is not None, the function will be called at
+        most that many times; once the limit is reached, the error that
+        triggered the final retry is re-raised, or TooManyAttemptsError if
+        the retry was not triggered by an error.
+
+        If the module-level variable "lazy_tracebacks" is true, the traceback
+        of an error (and hence the frames it refers to) is released as soon
+        as the handlers have chosen a restart for it, unless the error might
+        still be re-raised because this is the final permitted attempt.  This
+        also avoids a reference cycle between the traceback and this call's
+        frame, which would otherwise keep the failed frames alive until the
+        cyclic garbage collector runs.  An error raised by a restart via
+        RaiseNewError will then not inherit the original error's traceback.
         """
-        exc_type, exc_value, traceback = None, None, None
-        try:
-            return func(*args,**kwds)
-        except InvokeRestart, e:
-            if e.restart in self.restarts:
+        max_attempts = self.max_attempts
+        if max_attempts is None:
+            max_attempts = default_max_attempts
+        attempt = 0
+        while True:
+            attempt += 1
+            exc_type, exc_value, traceback = None, None, None
+            restart = None
+            try:
+                return func(*args,**kwds)
+            except InvokeRestart, e:
+                if e.restart in self.restarts:
+                    restart = e
+                else:
+                    raise
+            except Exception:
+                exc_type, exc_value, traceback = sys.exc_info()
+            while restart is not None or exc_value is not None:
+                if restart is None:
+                    try:
+                        self._invoke_handlers(exc_value,attempt,traceback)
+                    except InvokeRestart, e:
+                        if e.restart in self.restarts:
+                            restart = e
+                        else:
+                            raise
+                    else:
+                        raise exc_type, exc_value, traceback
+                if lazy_tracebacks:
+                    if max_attempts is None or attempt < max_attempts:
+                        traceback = None
+                        sys.exc_clear()
                 try:
-                    return e.invoke()
+                    return restart.invoke()
                 except RetryLastCall:
-                    return self(func,*args,**kwds)
+                    break
                 except RaiseNewError, newerr:
-                    exc_info = self._normalise_error(newerr.error)
+                    exc_info = _normalise_error(newerr.error)
                     exc_type, exc_value = exc_info[:2]
                     if exc_info[2] is not None:
                         traceback = exc_info[2]
+                    restart = None
             else:
-                raise
-        except Exception:
-            exc_type, exc_value, traceback = sys.exc_info()
-        while exc_value is not None:
+                return None
+            if max_attempts is not None and attempt >= max_attempts:
+                if exc_value is not None:
+                    raise exc_type, exc_value, traceback
+                raise TooManyAttemptsError(max_attempts)
+
+    def imap(self,func,iterable):
+        """Lazily invoke the given function on each item of an iterable.
+
+        This is a generator that yields func(item) for each item, invoking
+        the function in the context of this restart suite as for __call__.
+        Restarts apply to each item individually: if a restart returns a
+        value it is yielded in place of the result, if it asks for the call
+        to be retried then only that item is retried, and if it exits the
+        restart context (e.g. the "skip" restart) then the item is dropped.
+
+        Like __call__, this should only be used while the suite is
+        established.  Items are consumed one at a time, so this can be used
+        to stream through iterables that are too large to fit in memory.
+        """
+        call = self.__call__
+        for item in iterable:
             try:
-                self._invoke_handlers(exc_value)
-            except InvokeRestart, e:
-                if e.restart in self.restarts:
-                    try:
-                        return e.invoke()
-                    except RetryLastCall:
-                        return self(func,*args,**kwds)
-                    except RaiseNewError, newerr:
-                        exc_info = self._normalise_error(newerr.error)
-                        exc_type, exc_value = exc_info[:2]
-                        if exc_info[2] is not None:
-                            traceback = exc_info[2]
-                else:
+                value = call(func,item)
+            except ExitRestart, e:
+                if e.restart not in self.restarts:
                     raise
-            else:
-                raise exc_type, exc_value, traceback
-
-    def _normalise_error(self,error):
-        exc_type, exc_value, traceback = None, None, None
-        if isinstance(error,BaseException):
-            exc_type = type(error)
-            exc_value = error
-        elif isinstance(error,type):
-            exc_type = error
-            exc_value = error()
-        else:
-            values = tuple(error)
-            if len(values) == 1:
-                exc_type = values[0]
-                exc_info = exc_type()
-            elif len(values) == 2:
-                exc_type, exc_info = values
-            elif len(values) == 3:
-                exc_type, exc_value, traceback = values
-            else:
-                raise ValueError("too many items in exception tuple")
-        return exc_type, exc_value, traceback
+                continue
+            yield value
+
+    def map(self,func,iterable):
+        """Invoke the given function on each item of an iterable.
 
-    def __enter__(self):
-        _cur_restarts.push(self,1)
+        This returns a list of the results produced by imap().
+        """
+        return list(self.imap(func,iterable))
+
+    def __enter__(self,offset=1):
+        self._established = True
+        _cur_restarts.push(self,offset)
         return self
 
     def __exit__(self,exc_type,exc_value,traceback,internal=False):
         try:
             if exc_type is not None:
-                if exc_type is InvokeRestart:
+                if issubclass(exc_type,InvokeRestart):
                     for r in self.restarts:
                         if exc_value.restart is r:
                             return self._invoke_restart(exc_value)
@@ -474,7 +678,7 @@ class RestartSuite(object):
                         return False
                 else:
                     try:
-                        self._invoke_handlers(exc_value)
+                        self._invoke_handlers(exc_value,None,traceback)
                     except InvokeRestart, e:
                         for r in self.restarts:
                             if e.restart is r:
@@ -496,36 +700,116 @@ class RestartSuite(object):
         except RetryLastCall:
             return False
         except RaiseNewError, e:
-             exc_type, exc_value, traceback = self._normalise_error(e.error)
+             exc_type, exc_value, traceback = _normalise_error(e.error)
              return self.__exit__(exc_type,exc_value,traceback,internal=True)
         return True
 
-    def _invoke_handlers(self,e):
-        handlers = find_handlers(e)
-        if handlers:
-            for handler in handlers:
-                handler.handle_error(e)
+    def _invoke_handlers(self,e,attempt=None,traceback=None):
+        if _profiler is not None and traceback is not None:
+            _profiler.profile(self._dispatch_handlers,e,attempt,traceback)
         else:
-            if self.default_handlers is not None:
-                if isinstance(e,self.default_handlers.exc_type):
-                    self.default_handlers.handle_error(e)
+            self._dispatch_handlers(e,attempt)
+
+    def _dispatch_handlers(self,e,attempt,consulted=None):
+        old_attempt = getattr(_attempts,"current",None)
+        _attempts.current = attempt
+        try:
+            handlers = _find_handlers(e)
+            if handlers:
+                if consulted is not None:
+                    consulted.extend(handlers)
+                for handler in handlers:
+                    handler.handle_error(e)
+            else:
+                if self.default_handlers is not None:
+                    if isinstance(e,self.default_handlers.exc_type):
+                        if consulted is not None:
+                            consulted.append(self.default_handlers)
+                        self.default_handlers.handle_error(e)
+        finally:
+            _attempts.current = old_attempt
 
 #  Convenience name for accessing RestartSuite class.
 restarts = RestartSuite
 
 
+class FrozenRestartSuite(object):
+    """Immutable template for a suite of restarts.
+
+    FrozenRestartSuite takes the same arguments as RestartSuite, but does
+    all the work of building the suite up-front.  Entering it creates a
+    RestartSuite that shares the template's restarts, at almost no cost:
+
+        SKIP_OR_USE_VALUE = FrozenRestartSuite(skip,use_value)
+        for i in items:
+            with SKIP_OR_USE_VALUE as invoke:
+                total += invoke(calculate,i)
+
+    The suite returned by __enter__ can be modified as usual, e.g. using
+    add_restart() or by setting "default_handlers"; it takes a private copy
+    of the restarts when first modified, leaving the template unchanged.
+    The "default_handlers" and "max_attempts" of the template are copied
+    from the RestartSuite it was created from, if any.
+    """
+
+    __slots__ = ("restarts","default_handlers","max_attempts",)
+
+    def __init__(self,*restarts):
+        suite = RestartSuite(*restarts)
+        default_handlers = suite.default_handlers
+        max_attempts = suite.max_attempts
+        if len(restarts) == 1:
+            if isinstance(restarts[0],(RestartSuite,FrozenRestartSuite,)):
+                default_handlers = restarts[0].default_handlers
+                max_attempts = restarts[0].max_attempts
+        object.__setattr__(self,"restarts",tuple(suite.restarts))
+        object.__setattr__(self,"default_handlers",default_handlers)
+        object.__setattr__(self,"max_attempts",max_attempts)
+
+    def __setattr__(self,name,value):
+        raise AttributeError("FrozenRestartSuite objects are immutable")
+
+    def __enter__(self,offset=1):
+        suite = object.__new__(RestartSuite)
+        suite.restarts = self.restarts
+        suite.default_handlers = self.default_handlers
+        suite.max_attempts = self.max_attempts
+        suite._established = True
+        _cur_restarts.push(suite,offset)
+        return suite
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        return _cur_restarts.items().next().__exit__(exc_type,exc_value,
+                                                     traceback)
+
+
 def find_restart(name):
     """Find a defined restart with the given name.
 
     If no such restart is found then None is returned.
     """
-    for suite in _cur_restarts.items():
-        for restart in suite.restarts:
-            if restart.name == name or restart.func == name:
-                return restart
+    return _cur_restarts.find(name,_lookup_restart,_restarts_generation)
+
+
+def _lookup_restart(suite,name):
+    """Find the restart with the given name or function in a RestartSuite.
+
+    This is used as the lookup function for _cur_restarts.find(), which
+    memoises its results so that find_restart() can resolve a name in
+    constant time no matter how many RestartSuites are established.
+    """
+    for restart in suite.restarts:
+        if restart.name == name or restart.func == name:
+            return restart
     return None
 
 
+def _restarts_changed():
+    """Invalidate any cached results from find_restart()."""
+    global _restarts_generation
+    _restarts_generation += 1
+
+
 
 def invoke(func,*args,**kwds):
     """Invoke the given function, or return a value from a restart.
@@ -534,21 +818,215 @@ def invoke(func,*args,**kwds):
     the current restart context.  If the function runs to completion its
     result is returned.  If an error occurrs, the handlers are executed and
     the result from any invoked restart becomes the return value of the
-    function call.
+    function call.  Retries are limited by the module-level variable
+    "default_max_attempts", and tracebacks are released early if the variable
+    "lazy_tracebacks" is true, as for RestartSuite.__call__.
+    """
+    max_attempts = default_max_attempts
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return func(*args,**kwds)
+        except Exception, err:
+            exc_info = sys.exc_info()
+            try:
+                _invoke_handlers(err,attempt,exc_info[2])
+            except InvokeRestart, e:
+                if lazy_tracebacks:
+                    if max_attempts is None or attempt < max_attempts:
+                        exc_info = None
+                        sys.exc_clear()
+                try:
+                    return e.invoke()
+                except RetryLastCall:
+                    if max_attempts is not None and attempt >= max_attempts:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+            else:
+                raise
+
+
+def _invoke_handlers(err,attempt=None,traceback=None):
+    """Invoke the currently-established handlers for the given error.
+
+    This is the handler-dispatch logic used by invoke(); any InvokeRestart
+    raised by the handlers is propagated to the caller.  The traceback of
+    the error is passed on to the hot-spot profiler, if one is enabled.
     """
+    if _profiler is not None and traceback is not None:
+        _profiler.profile(_dispatch_handlers,err,attempt,traceback)
+    else:
+        _dispatch_handlers(err,attempt)
+
+
+def _dispatch_handlers(err,attempt,consulted=None):
+    """Run the handlers for the given error.
+
+    If 'consulted' is given, it is a list to which the handlers are added
+    before they are run; this is used by withrestart.monitoring.
+    """
+    old_attempt = getattr(_attempts,"current",None)
+    _attempts.current = attempt
     try:
-        return func(*args,**kwds)
-    except Exception, err:
+        handlers = _find_handlers(err)
+        if consulted is not None:
+            consulted.extend(handlers)
+        for handler in handlers:
+            handler.handle_error(err)
+    finally:
+        _attempts.current = old_attempt
+
+
+def current_attempt():
+    """Get the attempt number of the call whose error is being handled.
+
+    When called from a handler that was triggered by a function invoked
+    using RestartSuite.__call__ or invoke(), this returns 1 for errors from
+    the initial call, 2 for errors from the first retry, and so on.  At
+    other times it returns None.
+    """
+    return getattr(_attempts,"current",None)
+
+
+def signal(condition,*restarts):
+    """Signal a condition to the established handlers, without raising it.
+
+    The handlers for the given condition (an exception instance or class)
+    are run immediately, at the point of the call, rather than after the
+    stack has been unwound to the nearest restart context.  Any restarts
+    given as additional arguments are established while they run.
+
+    If a handler invokes one of those restarts, it is invoked right here
+    and signal() returns its return value, without unwinding the stack at
+    all.  If the restart asks to retry then the handlers are run again, and
+    if it exits its context then None is returned.  If a handler invokes
+    some other restart, an InvokeRestart is raised to transfer control to
+    it, unwinding the stack only as far as the context that established it.
+    If no handler invokes a restart, None is returned.
+    """
+    return _signal(condition,restarts)[1]
+
+
+def error(condition,*restarts):
+    """Signal a condition to the established handlers, raising it if unhandled.
+
+    This is exactly like signal(), except that if no handler invokes a
+    restart then the condition is raised as an exception.  For example,
+    the following lets handlers supply a default value for a missing key
+    without raising an exception unless there's no suitable handler:
+
         try:
-            for handler in find_handlers(err):
-                handler.handle_error(err)
-        except InvokeRestart, e:
+            value = data[key]
+        except KeyError, e:
+            value = error(e,use_value)
+
+    """
+    (invoked,value,condition) = _signal(condition,restarts)
+    if not invoked:
+        raise condition
+    return value
+
+
+#  Cache of FrozenRestartSuites for the restarts passed to signal(), which
+#  are pushed directly since they're only ever used to look up restarts.
+_signal_suites = {}
+
+def _signal(condition,restarts):
+    """Internal logic for signal() and error().
+
+    This returns a tuple (invoked,value,condition) indicating whether one of
+    the given restarts was invoked, the value that it returned, and the
+    condition that was finally signalled.
+    """
+    if isinstance(condition,type):
+        condition = condition()
+    if not restarts:
+        _invoke_handlers(condition)
+        return (False,None,condition)
+    try:
+        suite = _signal_suites[restarts]
+    except KeyError:
+        if len(_signal_suites) >= 100:
+            _signal_suites.clear()
+        suite = _signal_suites[restarts] = FrozenRestartSuite(*restarts)
+    max_attempts = default_max_attempts
+    attempt = 0
+    _cur_restarts.push(suite)
+    try:
+        while True:
+            attempt += 1
             try:
-                return e.invoke()
+                _invoke_handlers(condition,attempt)
+            except InvokeRestart, e:
+                if e.restart not in suite.restarts:
+                    raise
+                restart = e
+            else:
+                return (False,None,condition)
+            try:
+                return (True,restart.invoke(),condition)
+            except ExitRestart, e:
+                if e.restart not in suite.restarts:
+                    raise
+                return (True,None,condition)
             except RetryLastCall:
-                return invoke(func,*args,**kwds)
+                if max_attempts is not None and attempt >= max_attempts:
+                    return (False,None,condition)
+            except RaiseNewError, e:
+                (exc_type,exc_value,_) = _normalise_error(e.error)
+                if exc_value is None:
+                    exc_value = exc_type()
+                condition = exc_value
+    finally:
+        _cur_restarts.pop()
+
+
+def notify(condition):
+    """Notify the established handlers of a condition.
+
+    This is a lightweight version of signal() intended for conditions that
+    are not errors, such as progress notices, which may be signalled from
+    inside tight loops.  The handlers for the condition are run immediately,
+    and may invoke a restart as usual.  The handlers matching each class of
+    condition are cached along with the established handlers, so if none of
+    them matches then this returns almost immediately.
+    """
+    #  This inlines the cache lookup from _find_handlers(), ahead of any
+    #  other work.  Results are never cached for a class, so a class given
+    #  as the condition always misses and is instantiated below.
+    memo = _cur_handlers.memo()
+    if memo is not None:
+        try:
+            (generation,handlers) = memo[condition.__class__]
+        except KeyError:
+            pass
         else:
-            raise
+            if generation == _handlers_generation:
+                for handler in handlers:
+                    handler.handle_error(condition)
+                return None
+    if isinstance(condition,type):
+        condition = condition()
+    for handler in _find_handlers(condition):
+        handler.handle_error(condition)
+
+
+def warn(condition):
+    """Signal a warning to the established handlers.
+
+    The handlers for the given condition are run immediately, with the
+    "muffle_warning" restart established.  Unless one of them invokes it,
+    the warning is then issued using the standard warnings module.  The
+    condition may be a Warning instance or class, or a message string.
+    """
+    if isinstance(condition,basestring):
+        condition = UserWarning(condition)
+    elif isinstance(condition,type):
+        condition = condition()
+    if _find_handlers(condition):
+        if _signal(condition,(muffle_warning,))[0]:
+            return
+    warnings.warn(condition,stacklevel=2)
 
 
 class Handler(object):
@@ -563,6 +1041,8 @@ class Handler(object):
     explicitly invoking a restart.
     """
 
+    __slots__ = ("exc_type","func","args","kwds","_restart_name",)
+
     def __init__(self,exc_type,func,*args,**kwds):
         """Handler object initializer.
 
@@ -578,50 +1058,128 @@ class Handler(object):
         self.func = func
         self.args = args
         self.kwds = kwds
+        if isinstance(func,basestring):
+            self._restart_name = func
+        else:
+            self._restart_name = None
 
     def handle_error(self,e):
         """Invoke this handler on the given error.
 
         This is a simple wrapper method to implement the shortcut syntax of
-        passing the name of a restart directly into the handler.
+        passing the name of a restart directly into the handler.  The name
+        is resolved directly against the restart stack, whose memoised
+        lookups mean it's only matched once for each restart context.
         """
-        if isinstance(self.func,basestring):
-            raise InvokeRestart(self.func,*self.args,**self.kwds)
-        else:
+        name = self._restart_name
+        if name is None:
             self.func(e,*self.args,**self.kwds)
+        else:
+            restart = _cur_restarts.find(name,_lookup_restart,
+                                         _restarts_generation)
+            if restart is None:
+                raise MissingRestartError(name)
+            raise InvokeRestart(restart,*self.args,**self.kwds)
 
-    def __enter__(self):
-        _cur_handlers.push(self,1)
+    def __enter__(self,offset=1):
+        _cur_handlers.push(self,offset)
         return self
 
     def __exit__(self,exc_type,exc_value,traceback):
         _cur_handlers.pop()
 
 
+def _compile_handlers(suite):
+    """Get the dispatch information compiled from a suite's handlers.
+
+    This is a tuple (exc_type,table,nested) where 'exc_type' is a tuple of
+    the distinct exception types matched by the handlers, and 'table' is a
+    dict mapping exception classes to the handlers that match them.  The
+    table is filled in lazily by _handle_error().  A suite discards its
+    compiled information whenever it is modified, and 'nested' records the
+    compiled information of any suites nested inside it, so that it can be
+    rebuilt if one of those is modified.
+    """
+    compiled = suite._compiled
+    if compiled is not None:
+        for (nested,nested_compiled) in compiled[2]:
+            if _compile_handlers(nested) is not nested_compiled:
+                break
+        else:
+            return compiled
+    exc_types = []
+    seen = set()
+    nested = []
+    for handler in suite.handlers:
+        if isinstance(handler,(HandlerSuite,FrozenHandlerSuite,)):
+            nested.append((handler,_compile_handlers(handler)))
+        exc_type = handler.exc_type
+        if not isinstance(exc_type,tuple):
+            exc_type = (exc_type,)
+        for t in exc_type:
+            if t not in seen:
+                seen.add(t)
+                exc_types.append(t)
+    compiled = (tuple(exc_types),{},tuple(nested))
+    object.__setattr__(suite,"_compiled",compiled)
+    return compiled
+
+
+def _handle_error(suite,e):
+    """Invoke the handlers from a suite that match the given error.
+
+    The matching handlers for each class of error are found once and kept
+    in the suite's compiled dispatch table, so the cost of dispatching an
+    error doesn't depend on the number of handlers in the suite.
+    """
+    table = _compile_handlers(suite)[1]
+    cls = e.__class__
+    try:
+        handlers = table[cls]
+    except KeyError:
+        handlers = table[cls] = tuple([h for h in suite.handlers
+                                       if issubclass(cls,h.exc_type)])
+    for handler in handlers:
+        handler.handle_error(e)
+
+
 class HandlerSuite(object):
     """Class to easily combine multiple handlers into a single context.
 
     HandleSuite objects represent a set of Handlers that are pushed/popped
     as a group.  The suite can also have handlers dynamically added or removed,
-    allowing then to be defined in-line using decorator syntax.
+    allowing then to be defined in-line using decorator syntax.  The list of
+    handlers should only be modified using these methods.
+
+    Suites that are established over and over again can be built once using
+    the freeze() method and then entered as many times as required.
     """
 
+    #  The '_established' flag is set once the suite has been entered or
+    #  nested inside another suite, after which modifying it must invalidate
+    #  the cached results of _find_handlers().  It is never cleared.
+    __slots__ = ("handlers","_compiled","_established",)
+
     def __init__(self,*handlers):
         self.handlers = []
-        self.exc_type = ()
+        self._compiled = None
+        self._established = False
         for h in handlers:
-            if isinstance(h,(Handler,HandlerSuite,)):
+            if isinstance(h,(Handler,HandlerSuite,FrozenHandlerSuite,)):
                 self._add_handler(h)
             else:
                 self._add_handler(Handler(*h))
 
-    def handle_error(self,e):
-        for handler in self.handlers:
-            if isinstance(e,handler.exc_type):
-                handler.handle_error(e)
+    @property
+    def exc_type(self):
+        """Tuple of the exception types handled by this suite."""
+        return _compile_handlers(self)[0]
 
-    def __enter__(self):
-        _cur_handlers.push(self,1)
+    handle_error = _handle_error
+
+    def __enter__(self,offset=1):
+        self._established = True
+        _cur_handlers.push(self,offset)
         return self
 
     def __exit__(self,exc_type,exc_info,traceback):
@@ -650,7 +1208,7 @@ class HandlerSuite(object):
 
         """
         def do_add_handler(func):
-            if isinstance(func,(Handler,HandlerSuite,)):
+            if isinstance(func,(Handler,HandlerSuite,FrozenHandlerSuite,)):
                 h = func
             else:
                 if exc_type is not None:
@@ -676,14 +1234,14 @@ class HandlerSuite(object):
     def _add_handler(self,handler):
         """Internal logic for adding a handler to the suite.
 
-        This appends the handler to self.handlers, and adjusts self.exc_type
-        to reflect the newly-handled exception types.
+        This appends the handler to self.handlers, and arranges for the
+        suite's dispatch information to be recompiled.
         """
+        if isinstance(handler,HandlerSuite):
+            handler._established = True
+        self._unshare_handlers()
         self.handlers.append(handler)
-        if isinstance(handler.exc_type,tuple):
-            self.exc_type = self.exc_type + handler.exc_type
-        else:
-            self.exc_type = self.exc_type + (handler.exc_type,)
+        self._changed()
 
     def del_handler(self,handler):
         """Remove any handlers matching the given value from the suite.
@@ -693,35 +1251,296 @@ class HandlerSuite(object):
         """
         to_del = []
         for h in self.handlers:
-            if h is handler or h.func is handler or h.exc_type is handler:
+            if h is handler or h.exc_type is handler or \
+               getattr(h,"func",None) is handler:
                 to_del.append(h)
+        self._unshare_handlers()
         for h in to_del:
             self.handlers.remove(h)
+        self._changed()
+
+    def _changed(self):
+        """Discard any information computed from the suite's handlers."""
+        self._compiled = None
+        if self._established:
+            _handlers_changed()
+
+    def _unshare_handlers(self):
+        """Take a private copy of the handlers list before modifying it.
+
+        Suites entered from a FrozenHandlerSuite share its tuple of handlers
+        until they are first modified.
+        """
+        if type(self.handlers) is tuple:
+            self.handlers = list(self.handlers)
+
+    def freeze(self):
+        """Get an immutable FrozenHandlerSuite template of this suite."""
+        return FrozenHandlerSuite(self)
 
 #  Convenience name for accessing HandlerSuite class.
 handlers = HandlerSuite
 
 
+class FrozenHandlerSuite(object):
+    """Immutable template for a suite of handlers.
+
+    FrozenHandlerSuite takes the same arguments as HandlerSuite, but does
+    all the work of building the suite (including its combined "exc_type")
+    up-front.  Entering it creates a HandlerSuite that shares the template's
+    handlers, at almost no cost.  That suite can be modified as usual, e.g.
+    using add_handler(); it takes a private copy of the handlers when first
+    modified, leaving the template unchanged.
+
+    A FrozenHandlerSuite can also be used anywhere a HandlerSuite could be,
+    for example as the "default_handlers" of a RestartSuite.
+    """
+
+    __slots__ = ("handlers","_compiled",)
+
+    def __init__(self,*handlers):
+        if len(handlers) == 1 and isinstance(handlers[0],HandlerSuite):
+            suite = handlers[0]
+        else:
+            suite = HandlerSuite(*handlers)
+        object.__setattr__(self,"handlers",tuple(suite.handlers))
+        object.__setattr__(self,"_compiled",None)
+        _compile_handlers(self)
+
+    def __setattr__(self,name,value):
+        raise AttributeError("FrozenHandlerSuite objects are immutable")
+
+    @property
+    def exc_type(self):
+        """Tuple of the exception types handled by this suite."""
+        return _compile_handlers(self)[0]
+
+    handle_error = _handle_error
+
+    def __enter__(self,offset=1):
+        #  The suite shares our dispatch table until it is modified.
+        suite = object.__new__(HandlerSuite)
+        suite.handlers = self.handlers
+        suite._compiled = _compile_handlers(self)
+        suite._established = True
+        _cur_handlers.push(suite,offset)
+        return suite
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        return _cur_handlers.items().next().__exit__(exc_type,exc_value,
+                                                     traceback)
+
+
 def find_handlers(err):
     """Find the currently-established handlers for the given error.
 
     This function returns a list of all handlers currently established for
     the given error, in the order in which they should be invoked.
     """
+    return list(_find_handlers(err))
+
+
+def _find_handlers(err):
+    """Internal version of find_handlers(), returning a shared tuple.
+
+    The handlers found for each class of error are cached on the top entry
+    of the handler stack, so they only need to be recomputed when handlers
+    are pushed or popped, or when an established HandlerSuite is modified.
+    """
+    generation = _handlers_generation
+    memo = _cur_handlers.memo()
+    if memo is not None:
+        try:
+            (cached_generation,handlers) = memo[err.__class__]
+        except KeyError:
+            pass
+        else:
+            if cached_generation == generation:
+                return handlers
     handlers = []
     for handler in _cur_handlers.items():
         if isinstance(err,handler.exc_type):
             handlers.append(handler)
+    handlers = tuple(handlers)
+    if memo is not None and not isinstance(err,type):
+        memo[err.__class__] = (generation,handlers)
     return handlers
 
 
+def capture_handlers():
+    """Capture the currently-established handlers as a FrozenHandlerSuite.
+
+    The returned suite contains every handler visible at the point of the
+    call, innermost first.  Entering it in another thread makes those
+    handlers available there too, which is how errors raised by work sent
+    to a thread pool can be handled by the code that submitted it.
+
+    The captured suite is cached on the top entry of the handler stack, so
+    capturing repeatedly from the same context is cheap.
+    """
+    #  This shares the memo used by _find_handlers(), but is keyed by the
+    #  FrozenHandlerSuite class so it can't clash with an exception class.
+    generation = _handlers_generation
+    memo = _cur_handlers.memo()
+    if memo is not None:
+        try:
+            (cached_generation,captured) = memo[FrozenHandlerSuite]
+        except KeyError:
+            pass
+        else:
+            if cached_generation == generation:
+                return captured
+    captured = object.__new__(FrozenHandlerSuite)
+    object.__setattr__(captured,"handlers",tuple(_cur_handlers.items()))
+    object.__setattr__(captured,"_compiled",None)
+    if memo is not None:
+        memo[FrozenHandlerSuite] = (generation,captured)
+    return captured
+
+
+def _handlers_changed():
+    """Invalidate any cached results from _find_handlers()."""
+    global _handlers_generation
+    _handlers_generation += 1
+
+
+class ContextSnapshot(object):
+    """Immutable snapshot of the established restarts and handlers.
+
+    Instances are created by capture_context(), and the captured restarts
+    and handlers can be established again using run_in_context().
+    """
+
+    __slots__ = ("restarts","handlers",)
+
+    def __init__(self,restarts,handlers):
+        object.__setattr__(self,"restarts",restarts)
+        object.__setattr__(self,"handlers",handlers)
+
+    def __setattr__(self,name,value):
+        raise AttributeError("ContextSnapshot objects are immutable")
+
+
+def capture_context():
+    """Capture the currently-established restarts and handlers.
+
+    This returns a ContextSnapshot that can be passed to run_in_context(),
+    e.g. to make the current recovery context available to a callback that
+    will run later or in another thread.  The snapshot shares structure
+    with the restart and handler stacks, so capturing it is cheap.
+    """
+    return ContextSnapshot(_cur_restarts.snapshot(),_cur_handlers.snapshot())
+
+
+def run_in_context(snapshot,func,*args,**kwds):
+    """Call func(*args,**kwds) within a captured restart/handler context.
+
+    While the function runs, exactly those restarts and handlers that were
+    established when the snapshot was captured are visible, in place of
+    any that are established in the calling code.  Restarts and handlers
+    established by the function itself work as usual.
+    """
+    old_restarts = _cur_restarts.swap(snapshot.restarts)
+    try:
+        old_handlers = _cur_handlers.swap(snapshot.handlers)
+        try:
+            return func(*args,**kwds)
+        finally:
+            _cur_handlers.swap(old_handlers)
+    finally:
+        _cur_restarts.swap(old_restarts)
+
+
+class ScopedGenerator(object):
+    """Generator wrapper that keeps the generator's contexts to itself.
+
+    Restarts and handlers established by the wrapped generator are swapped
+    into the current stacks each time it is resumed, and swapped out again
+    each time it yields.  While it is suspended they are not on the stacks
+    at all, so they cost nothing to code running elsewhere, and swapping
+    them back in takes constant time in the common case of resuming it
+    from the same context as before.  Use the scoped_generator() decorator
+    to wrap all the generators produced by a generator function.
+
+    If the wrapper is dropped while the generator is suspended inside a
+    context, for example by breaking out of a loop over it, the generator
+    is closed with its own items swapped in so that it exits its contexts
+    cleanly.  This is done from a weakref callback rather than __del__,
+    so that wrappers caught in reference cycles can still be collected.
+    """
+
+    __slots__ = ("gen","_segments","__weakref__",)
+
+    def __init__(self,gen):
+        self.gen = gen
+        #  The saved items of the generator's restarts and handlers, shared
+        #  with the callback that closes it once the wrapper is dropped.
+        self._segments = segments = [None,None]
+        _scoped_refs.add(weakref.ref(self,lambda ref:
+                                     _close_scoped(ref,gen,segments)))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        gen = self.gen
+        segments = self._segments
+        restarts = _cur_restarts.resume(segments[0],gen.gi_frame)
+        handlers = _cur_handlers.resume(segments[1],gen.gi_frame)
+        try:
+            return gen.next()
+        finally:
+            segments[1] = _cur_handlers.suspend(handlers)
+            segments[0] = _cur_restarts.suspend(restarts)
+
+    def send(self,value):
+        return _resume_scoped(self.gen,self._segments,self.gen.send,value)
+
+    def throw(self,*args):
+        return _resume_scoped(self.gen,self._segments,self.gen.throw,*args)
+
+    def close(self):
+        return _resume_scoped(self.gen,self._segments,self.gen.close)
+
+
+#  Weak references to the live ScopedGenerators, kept so that their
+#  callbacks are called when the wrappers are dropped.
+_scoped_refs = set()
+
+def _resume_scoped(gen,segments,method,*args):
+    """Call a method of a scoped generator with its items swapped in."""
+    frame = gen.gi_frame
+    restarts = _cur_restarts.resume(segments[0],frame)
+    handlers = _cur_handlers.resume(segments[1],frame)
+    try:
+        return method(*args)
+    finally:
+        segments[1] = _cur_handlers.suspend(handlers)
+        segments[0] = _cur_restarts.suspend(restarts)
+
+def _close_scoped(ref,gen,segments):
+    """Close the generator of a dropped ScopedGenerator."""
+    _scoped_refs.discard(ref)
+    if gen.gi_frame is not None:
+        _resume_scoped(gen,segments,gen.close)
+
+
+def scoped_generator(func):
+    """Decorator making a generator function produce ScopedGenerators."""
+    def wrapper(*args,**kwds):
+        return ScopedGenerator(func(*args,**kwds))
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
 def skip():
     """Pre-defined restart that skips to the end of the restart context."""
-    raise ExitRestart
+    raise _EXIT_RESTART
 
 def retry():
     """Pre-defined restart that retries the most-recently-invoked function."""
-    raise RetryLastCall
+    raise _RETRY_LAST_CALL
 
 def raise_error(error):
     """Pre-defined restart that raises the given error."""
@@ -731,6 +1550,10 @@ def use_value(value):
     """Pre-defined restart that returns the given value."""
     return value
 
+def muffle_warning():
+    """Pre-defined restart that suppresses a warning signalled by warn()."""
+    return None
+
 
 def _load_name_in_scope(func,name):
     """Get the value of variable 'name' as seen in scope of given function.
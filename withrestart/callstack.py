@@ -9,17 +9,30 @@ suspended generators etc.
 
 To work correctly while mixing CallStack operations with generators, this
 module requires a working implementation of sys._getframe().
+
+An alternative engine, ContextCallStack, keeps a simple linked stack for each
+thread and never walks the chain of execution frames.  It offers constant-time
+push and pop, at the cost of seeing the items of a resumed generator in push
+order, and of requiring generators to stay in one thread.  The engine used for
+the restart and handler stacks of the main withrestart module can be chosen
+by setting the environment variable WITHRESTART_CALLSTACK to the name of one
+of the engines in the ENGINES dict, or by calling set_callstack_engine().
  
 """
 
+import os
 import sys
+import threading
+import weakref
+from dis import opmap
+from inspect import CO_GENERATOR
+from types import FrameType
 
 try:
     from sys import _getframe
     _getframe()
 except Exception:
     try:
-        import threading
         class _DummyFrame:
             f_back = None
             def __init__(self):
@@ -57,6 +70,199 @@ if "psyco" in sys.modules:
     enable_psyco_support()
 
 
+_RETURN_VALUE = opmap["RETURN_VALUE"]
+
+def _has_returned(frame):
+    """Check whether the given execution frame has returned.
+
+    A frame that is still executing must be part-way through some sort of
+    call, while one that has returned is left pointing at its RETURN_VALUE
+    opcode.  This lets us detect items that were pushed without being popped
+    without walking up the chain of execution frames.
+    """
+    try:
+        return ord(frame.f_code.co_code[frame.f_lasti]) == _RETURN_VALUE
+    except (AttributeError,IndexError,TypeError):
+        return False
+
+
+_WITH_OPCODES = "".join(chr(opmap[name])
+                        for name in ("SETUP_WITH","BEFORE_WITH")
+                        if name in opmap)
+
+def _in_with_statement(frame):
+    """Check whether the given execution frame is entering a with-statement.
+
+    Items pushed by the __enter__ method of a context manager are sure to be
+    popped again by its __exit__ method, even if the frame exits by raising
+    an error.  Items pushed in any other way may be left behind by such a
+    frame, and must be checked for using _has_exited().
+    """
+    try:
+        return frame.f_code.co_code[frame.f_lasti] in _WITH_OPCODES
+    except (AttributeError,IndexError,TypeError):
+        return False
+
+
+def _has_exited(frame,current):
+    """Check whether the given execution frame has exited.
+
+    This works for frames that exited by raising an error as well as those
+    that returned, but takes time proportional to the depth of the stack.
+    A frame that is still running in this thread is found by walking up the
+    chain of execution frames from the current frame.  If it is not found,
+    but one of its callers is, then it must have exited.  If neither is
+    found, it belongs to some other thread and is assumed to be running.
+    """
+    f = current
+    while f is not None:
+        if f is frame:
+            return False
+        f = f.f_back
+    chain = set()
+    while current is not None:
+        chain.add(id(current))
+        current = current.f_back
+    frame = frame.f_back
+    while frame is not None:
+        if id(frame) in chain:
+            return True
+        frame = frame.f_back
+    return False
+
+
+def _is_dead(entry,current):
+    """Check whether the frame owning a non-generator entry has exited.
+
+    This is inlined in the hot paths of CallStack, as the common case of a
+    guarded entry whose frame has not returned.
+    """
+    if entry.guarded:
+        return _has_returned(entry.frame)
+    return _has_returned(entry.frame) or _has_exited(entry.frame,current)
+
+
+class _Entry(object):
+    """Entry in the linked stack of items for a single thread.
+
+    Each entry records the pushed item, the frame that owns it and the next
+    entry down the stack.  Entries are never modified once created, apart
+    from the 'memo' dict used to cache results computed from the stack.  The
+    attribute 'ngen' counts the entries from here down that are owned by
+    generator frames, so the common case of a stack containing no such
+    entries can be detected in constant time, and 'size' counts all the
+    entries from here down.  The attribute 'guarded' is true if the entry
+    was pushed on entry to a with-statement, and so will be popped even if
+    its frame exits by raising an error.
+    """
+
+    __slots__ = ("item","frame","next","in_generator","guarded","ngen",
+                 "size","memo",)
+
+    def __init__(self,item,frame,next,in_generator=False,guarded=True):
+        self.item = item
+        self.frame = frame
+        self.next = next
+        self.memo = None
+        self.in_generator = in_generator
+        self.guarded = guarded
+        if next is None:
+            self.ngen = int(in_generator)
+            self.size = 1
+        else:
+            self.ngen = next.ngen + in_generator
+            self.size = next.size + 1
+
+
+def _in_generator(frame):
+    """Check whether the given execution frame belongs to a generator."""
+    try:
+        return bool(frame.f_code.co_flags & CO_GENERATOR)
+    except AttributeError:
+        return False
+
+
+def _rebuild(prefix,entry):
+    """Rebuild the given list of entries on top of another entry."""
+    for old_entry in reversed(prefix):
+        entry = _Entry(old_entry.item,old_entry.frame,entry,
+                       old_entry.in_generator,old_entry.guarded)
+    return entry
+
+
+def _rebase(top,old_base,base):
+    """Move the entries from 'top' down to 'old_base' on top of 'base'."""
+    if old_base is base:
+        return top
+    prefix = []
+    while top is not old_base and top is not None:
+        prefix.append(top)
+        top = top.next
+    return _rebuild(prefix,base)
+
+
+def _find_memoised(entry,key,lookup,stamp,frame=None):
+    """Find value for key from the given entry down, memoising the result.
+
+    This is the implementation of the find() method on the various stack
+    classes.  It walks down the stack until it finds an entry that provides
+    the key or has it memoised, then records the value on every entry that
+    it passed along the way.  The entry that provides the value is not
+    updated, since re-doing its lookup is already cheap.  The 'frame' is
+    the current execution frame, used to check for entries whose frames
+    have exited; it may be omitted if the entries have no frames.
+    """
+    passed = []
+    value = None
+    while entry is not None:
+        memo = entry.memo
+        if memo is not None:
+            try:
+                (memo_stamp,memo_value) = memo[key]
+            except KeyError:
+                pass
+            else:
+                if memo_stamp == stamp:
+                    value = memo_value
+                    break
+        if not _has_returned(entry.frame) and \
+           (entry.guarded or not _has_exited(entry.frame,frame)):
+            value = lookup(entry.item,key)
+            if value is not None:
+                break
+        passed.append(entry)
+        entry = entry.next
+    for entry in passed:
+        if entry.memo is None:
+            entry.memo = {}
+        entry.memo[key] = (stamp,value)
+    return value
+
+
+#  Minimum number of entries a stack may hold before it is swept.
+_SWEEP_LIMIT = 64
+
+#  Used to find frames that are referenced only by a stack's own entries.
+#  Without it, only the entries of returned frames can be swept.
+_getrefcount = getattr(sys,"getrefcount",None)
+
+
+class _ThreadStack(object):
+    """Holder for the top entry of a single thread's stack.
+
+    The attribute 'limit' gives the size at which the stack will next be
+    swept for entries that can never be seen again, and 'hosted' gives the
+    frame of the generator whose items are currently swapped in by resume().
+    """
+
+    __slots__ = ("top","limit","hosted","__weakref__",)
+
+    def __init__(self):
+        self.top = None
+        self.limit = _SWEEP_LIMIT
+        self.hosted = None
+
+
 class CallStack(object):
     """Class managing per-call-stack context information.
 
@@ -67,17 +273,67 @@ class CallStack(object):
         * push(item):  add an item to the stack for the current exec frame
         * pop(item):   pop an item from the stack for the current exec frame
         * items():     get iterator over stack of items for the current frame
+        * memo():      get dict for caching results computed from the items
+        * find(key,lookup):  find the value for a key in the innermost item
+        * snapshot():  get an immutable snapshot of the current items
+        * swap(top):   replace the current items with a snapshot
+        * resume(segment,frame):  swap in the saved items of a generator
+        * suspend(token):  swap out the items of a generator
+        * sweep():     drop entries that can never be seen again
+        * stats():     get counts of live and reclaimed entries
+
+    Each thread has its own linked stack of entries, and each entry is tagged
+    with the frame that pushed it.  Looking up items therefore costs time
+    proportional to the number of entries, not to the depth of the call stack.
+    Entries owned by a frame that has exited are skipped entirely.
 
+    Items pushed by a generator frame are kept off the per-thread stacks, in
+    a linked stack of their own for each such frame, since the generator may
+    be resumed in any thread.  They are only visible while the generator is
+    running, and while any generator holding items is running, the items are
+    ordered by walking the chain of execution frames instead.
+
+    Items that are pushed but never popped, for example by a generator that
+    is abandoned while suspended, keep their owning frame alive for as long
+    as they remain on the stack.  To keep this bounded, each thread's stack
+    is swept whenever it has doubled in size since the last sweep, dropping
+    the entries of frames that have returned or are no longer referenced
+    from anywhere else, and the same is done for the stacks of generators.
+    The stacks of threads that have died are released along with their
+    thread-local storage.
     """
 
     def __init__(self):
-        self._frame_stacks = {}
+        self._local = threading.local()
+        self._stacks = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._reclaimed = 0
+        self._generators = {}
+        self._generators_limit = _SWEEP_LIMIT
+
+    def _get_stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            stack = self._local.stack = _ThreadStack()
+            self._stacks.add(stack)
+            return stack
 
     def __len__(self):
-        return len(self._frame_stacks)
+        count = 0
+        for stack in list(self._stacks):
+            entry = stack.top
+            while entry is not None:
+                count += 1
+                entry = entry.next
+        for entry in self._generators.values():
+            count += entry.size
+        return count
 
     def clear(self):
-        self._frame_stacks.clear()
+        for stack in list(self._stacks):
+            stack.top = None
+        self._generators.clear()
 
     def push(self,item,offset=0):
         """Push the given item onto the stack for current execution frame.
@@ -87,38 +343,658 @@ class CallStack(object):
         """
         # We add one to the offset to account for this function call.
         frame = _getframe(offset+1)
+        stack = self._get_stack()
+        #  This inlines _in_generator(frame) and _in_with_statement(frame).
+        #  Items of a hosted generator are swapped out when it yields, so
+        #  they can be kept on the stack like those of any other frame.
+        in_generator = guarded = False
         try:
-            frame_stack = self._frame_stacks[frame]
-        except KeyError:
-            self._frame_stacks[frame] = frame_stack = []
-        frame_stack.append(item)
+            code = frame.f_code
+            in_generator = bool(code.co_flags & CO_GENERATOR) and \
+                           frame is not stack.hosted
+            guarded = code.co_code[frame.f_lasti] in _WITH_OPCODES
+        except (AttributeError,IndexError,TypeError):
+            pass
+        if in_generator:
+            self._push_generator(item,frame,guarded)
+            return
+        top = stack.top = _Entry(item,frame,stack.top,False,guarded)
+        if top.size > stack.limit:
+            self._sweep(stack,frame)
+
+    def _push_generator(self,item,frame,guarded):
+        """Push an item onto the stack of the given generator frame."""
+        generators = self._generators
+        generators[frame] = _Entry(item,frame,generators.get(frame),
+                                   False,guarded)
+        if len(generators) > self._generators_limit:
+            self._sweep_generators()
 
     def pop(self):
         """Pop the top item from the stack for the current execution frame."""
+        stack = self._get_stack()
+        top = stack.top
+        if self._generators and self._pop_generator(top):
+            return
+        if top is None:
+            raise IndexError("stack is empty")
+        if not _has_returned(top.frame) and \
+           (top.guarded or not _has_exited(top.frame,_getframe(1))):
+            stack.top = top.next
+            return
         frame = _getframe(1)
-        frame_stack = None
-        while frame_stack is None:
-            try:
-                frame_stack = self._frame_stacks[frame]
-            except KeyError:
-                frame = frame.f_back
-                if frame is None:
-                    raise IndexError("stack is empty")
-        frame_stack.pop()
-        if not frame_stack:
-            del self._frame_stacks[frame]
+        entries = self._visible_entries(top,frame,None)
+        if not entries:
+            raise IndexError("stack is empty")
+        #  The target entry may be buried beneath entries belonging to
+        #  exited frames.  Drop them along with it.
+        target = entries[0]
+        prefix = []
+        dropped = 0
+        entry = top
+        while entry is not target:
+            if not _is_dead(entry,frame):
+                prefix.append(entry)
+            else:
+                dropped += 1
+            entry = entry.next
+        stack.top = _rebuild(prefix,target.next)
+        if dropped:
+            self._count_reclaimed(dropped)
+
+    def _pop_generator(self,top):
+        """Pop the top item of a generator, if it owns the innermost item.
+
+        The chain of execution frames is walked up from the caller of pop()
+        until it reaches the owner of the given top entry of this thread's
+        stack, or a generator frame that holds items.  In the latter case
+        the generator's top item is popped and True is returned.
+        """
+        generators = self._generators
+        if top is None:
+            owner = None
+        else:
+            owner = top.frame
+        frame = _getframe(2)
+        while frame is not None and frame is not owner:
+            entry = generators.get(frame)
+            if entry is not None:
+                if entry.next is None:
+                    del generators[frame]
+                else:
+                    generators[frame] = entry.next
+                return True
+            frame = frame.f_back
+        return False
+
+    def _running_generators(self):
+        """Get dict mapping running generator frames to their top entries.
+
+        A generator's frame is only linked to its caller while it runs, so
+        those that are suspended can be skipped without walking anything.
+        """
+        running = {}
+        for (frame,entry) in self._generators.items():
+            if frame.f_back is not None:
+                running[frame] = entry
+        return running
+
+    def _count_reclaimed(self,count):
+        self._lock.acquire()
+        try:
+            self._reclaimed += count
+        finally:
+            self._lock.release()
+
+    def sweep(self):
+        """Drop entries that can never be seen again.
+
+        This happens automatically as the stacks grow, but can be called
+        explicitly to release abandoned frames sooner.  It sweeps the stack
+        of the current thread and the stacks of all generators, and returns
+        the number of entries that were dropped.
+        """
+        dropped = self._sweep(self._get_stack(),_getframe(1))
+        return dropped + self._sweep_generators()
+
+    def _sweep(self,stack,current):
+        """Drop entries owned by frames that can no longer use them.
+
+        An entry is dead if its frame has exited without popping it, or
+        if the only references to its frame come from the stack itself.
+        A frame that is still in use keeps the entries of its callers alive
+        too, since they may become visible again when it returns.
+        """
+        entries = []
+        held = {}
+        entry = stack.top
+        while entry is not None:
+            entries.append(entry)
+            if entry.frame is not None:
+                key = id(entry.frame)
+                held[key] = held.get(key,0) + 1
+            entry = entry.next
+        #  Each held frame's reference to its caller also comes from us.
+        seen = set()
+        for entry in entries:
+            frame = entry.frame
+            if frame is None or id(frame) in seen:
+                continue
+            seen.add(id(frame))
+            back = getattr(frame,"f_back",None)
+            if back is not None and id(back) in held:
+                held[id(back)] += 1
+        back = None
+        live = set()
+        for entry in entries:
+            frame = entry.frame
+            if frame is None or id(frame) in live:
+                continue
+            #  The local variable and the argument to getrefcount() account
+            #  for two references, beyond those held by the stack.
+            if _getrefcount is None or not isinstance(frame,FrameType) \
+               or _getrefcount(frame) - 2 > held[id(frame)]:
+                while frame is not None and id(frame) in held:
+                    live.add(id(frame))
+                    frame = getattr(frame,"f_back",None)
+        frame = None
+        prefix = []
+        dropped = 0
+        bottom = None
+        for (i,entry) in enumerate(entries):
+            if entry.frame is None:
+                prefix.append(entry)
+            elif id(entry.frame) not in live or _is_dead(entry,current):
+                dropped += 1
+                bottom = i
+            else:
+                prefix.append(entry)
+        if dropped:
+            del prefix[bottom+1-dropped:]
+            stack.top = _rebuild(prefix,entries[bottom].next)
+            self._count_reclaimed(dropped)
+        if stack.top is None:
+            stack.limit = _SWEEP_LIMIT
+        else:
+            stack.limit = max(_SWEEP_LIMIT,2 * stack.top.size)
+        return dropped
+
+    def _sweep_generators(self):
+        """Drop the entries of generators that can never be resumed.
+
+        A generator can never be resumed once its frame has returned, or
+        once the only references to its frame come from its own entries,
+        as happens when a suspended generator is garbage-collected without
+        popping its items.  Running generators are always kept.
+        """
+        generators = self._generators
+        dropped = 0
+        for frame in generators.keys():
+            top = generators.get(frame)
+            if top is None or frame.f_back is not None:
+                continue
+            #  The local variable, the list of keys, the dict itself and
+            #  the argument to getrefcount() account for four references.
+            if _has_returned(frame) or (_getrefcount is not None and
+               isinstance(frame,FrameType) and
+               _getrefcount(frame) - 4 <= top.size):
+                if generators.get(frame) is top:
+                    del generators[frame]
+                    dropped += top.size
+        frame = None
+        if dropped:
+            self._count_reclaimed(dropped)
+        self._generators_limit = max(_SWEEP_LIMIT,2 * len(generators))
+        return dropped
+
+    def stats(self):
+        """Get a dict counting the live and reclaimed entries.
+
+        The key "live" gives the number of entries currently held across
+        all threads, and "reclaimed" gives the total number of entries that
+        have been dropped because their frames returned or were abandoned.
+        """
+        return {"live": len(self), "reclaimed": self._reclaimed}
 
     def items(self):
         """Iterator over stack of items for current execution frame."""
+        entry = self._get_stack().top
         frame = _getframe(1)
+        if self._generators:
+            running = self._running_generators()
+            if running:
+                for entry in self._visible_entries(entry,frame,running):
+                    yield entry.item
+                return
+        while entry is not None:
+            if not _is_dead(entry,frame):
+                yield entry.item
+            entry = entry.next
+
+    def memo(self):
+        """Get a dict for memoising results computed from the current items.
+
+        The dict is attached to the top entry of the stack, so it is only
+        seen while that entry remains on top.  If the stack is empty, or if
+        its visible items might change without a push or pop (because some
+        of them belong to running generators) then None is returned and
+        results should not be memoised.
+        """
+        #  This is called on every notify(), so the common case of a guarded
+        #  entry on top of the stack is checked without any function calls.
+        #  Guarded entries are always popped by their with-statement, so
+        #  they can't be left behind by a frame that has returned.
+        try:
+            top = self._local.stack.top
+        except AttributeError:
+            return None
+        if top is None:
+            return None
+        if not top.guarded:
+            if _has_returned(top.frame):
+                return None
+            if _has_exited(top.frame,_getframe(1)):
+                return None
+        if self._generators and self._running_generators():
+            return None
+        memo = top.memo
+        if memo is None:
+            memo = top.memo = {}
+        return memo
+
+    def find(self,key,lookup,stamp=None):
+        """Find the value for 'key' provided by the innermost item.
+
+        The function 'lookup' is called as lookup(item,key) and must return
+        the value provided by that item, or None if it provides no value for
+        the key.  The result for each key is memoised on the entries of the
+        stack along with the given 'stamp', so repeated lookups take constant
+        time no matter how many items are on the stack.  Callers should pass
+        a new stamp whenever the value provided by an item may have changed,
+        and should always use the same lookup function for a given stack.
+        """
+        top = self._get_stack().top
+        if self._generators:
+            running = self._running_generators()
+        else:
+            running = None
+        if top is None and not running:
+            return None
+        frame = _getframe(1)
+        if running or _has_returned(top.frame) or \
+           (not top.guarded and _has_exited(top.frame,frame)):
+            for entry in self._visible_entries(top,frame,running):
+                value = lookup(entry.item,key)
+                if value is not None:
+                    return value
+            return None
+        return _find_memoised(top,key,lookup,stamp,frame)
+
+    def _visible_entries(self,top,frame,running):
+        """Get list of entries visible from the given frame, innermost first.
+
+        Entries owned by frames that have already exited are skipped.  If
+        'running' maps any generator frames to their top entries, the items
+        of those on the chain of execution frames are included, and all the
+        entries are ordered by walking up the chain.
+        """
+        if running:
+            return self._visible_entries_by_frame(top,frame,running)
+        entries = []
+        entry = top
+        while entry is not None:
+            if not _is_dead(entry,frame):
+                entries.append(entry)
+            entry = entry.next
+        return entries
+
+    def _visible_entries_by_frame(self,top,frame,running):
+        """Get list of visible entries by walking the execution frames."""
+        frame_entries = {}
+        entry = top
+        while entry is not None:
+            try:
+                frame_entries[entry.frame].append(entry)
+            except KeyError:
+                frame_entries[entry.frame] = [entry]
+            entry = entry.next
+        for (gen_frame,entry) in running.iteritems():
+            gen_entries = frame_entries.setdefault(gen_frame,[])
+            while entry is not None:
+                gen_entries.append(entry)
+                entry = entry.next
+        entries = []
         while frame is not None:
             try:
-                frame_stack = self._frame_stacks[frame]
+                entries.extend(frame_entries[frame])
             except KeyError:
                 pass
-            else:
-                for item in reversed(frame_stack):
-                    yield item
             frame = frame.f_back
+        #  Entries from a snapshot have no frame, and sit beneath the rest.
+        entries.extend(frame_entries.get(None,()))
+        return entries
+
+    def snapshot(self):
+        """Get an immutable snapshot of the items for current execution frame.
+
+        The snapshot is a linked chain of entries that are not tied to any
+        execution frame, so it remains valid after the frames that pushed
+        the items have returned.  It can be installed in any thread using
+        swap().  Snapshots are memoised on the entries of the stack, so
+        taking one repeatedly from the same context takes constant time,
+        and snapshots taken at different depths share their common tail.
+        """
+        top = self._get_stack().top
+        if self._generators:
+            running = self._running_generators()
+        else:
+            running = None
+        if top is None and not running:
+            return None
+        frame = _getframe(1)
+        if running or _is_dead(top,frame):
+            snapshot = None
+            for entry in reversed(self._visible_entries(top,frame,running)):
+                snapshot = _Entry(entry.item,None,snapshot)
+            return snapshot
+        passed = []
+        snapshot = None
+        entry = top
+        while entry is not None:
+            if entry.frame is None:
+                snapshot = entry
+                break
+            memo = entry.memo
+            if memo is not None:
+                try:
+                    snapshot = memo[_Entry]
+                except KeyError:
+                    pass
+                else:
+                    break
+            passed.append(entry)
+            entry = entry.next
+        for entry in reversed(passed):
+            if not _is_dead(entry,frame):
+                snapshot = _Entry(entry.item,None,snapshot)
+            if entry.memo is None:
+                entry.memo = {}
+            entry.memo[_Entry] = snapshot
+        return snapshot
+
+    def swap(self,top):
+        """Replace the stack for the current thread with the given snapshot.
+
+        The previous top of the stack is returned, and can be passed back
+        to swap() to restore it.  While a snapshot is installed its items
+        are visible regardless of the current execution frame, and items
+        pushed on top of it behave as usual.
+        """
+        stack = self._get_stack()
+        old_top = stack.top
+        stack.top = top
+        return old_top
+
+    def resume(self,segment,frame):
+        """Swap in the saved items of a generator that is about to resume.
+
+        The 'segment' is the value returned by suspend() when the generator
+        last yielded, or None if it had no items.  Its items are placed on
+        top of the current stack, and while the generator runs, items that
+        it pushes are treated like those of any other frame.  This returns
+        a token that must be passed to suspend() once the generator yields.
+        If the generator resumes on top of the same items as before, this
+        takes constant time; otherwise its own items are rebuilt.
+        """
+        stack = self._get_stack()
+        base = stack.top
+        token = (stack,base,stack.hosted)
+        stack.hosted = frame
+        if segment is not None:
+            stack.top = _rebase(segment[0],segment[1],base)
+        return token
+
+    def suspend(self,token):
+        """Swap out the items of a generator that has just yielded.
+
+        The stack is returned to the state it was in before the matching
+        call to resume(), and the generator's items are returned as a
+        segment that can be passed to resume() when it is next resumed.
+        """
+        (stack,base,hosted) = token
+        top = stack.top
+        stack.top = base
+        stack.hosted = hosted
+        if top is base:
+            return None
+        return (top,base)
+
+
+class _LocalTop(threading.local):
+    """Thread-local holder for the top entry of a ContextCallStack."""
+
+    top = None
+
+
+def _on_chain(frame,current):
+    """Check whether a frame is the current frame or one of its callers."""
+    while current is not None:
+        if current is frame:
+            return True
+        current = current.f_back
+    return False
+
+
+def _is_suspended(entry):
+    """Check whether an entry is owned by a suspended generator."""
+    return entry.in_generator and entry.frame.f_back is None
+
+
+class ContextCallStack(object):
+    """Class managing per-thread stack information as a simple linked list.
+
+    This class provides the same interface as CallStack, but keeps a single
+    immutable linked list of entries for each thread, in push order, and
+    does not walk the chain of execution frames to decide what is visible.
+    Pushing and popping items therefore takes constant time regardless of
+    the depth of the call stack.
+
+    Each entry still records the frame that pushed it.  Items pushed by a
+    generator are hidden while it is suspended, and an item is only popped
+    by a frame that owns it: if the top item belongs to some other frame,
+    such as a suspended generator, the innermost item owned by the caller
+    is removed from beneath it instead.  Since the items of a resumed
+    generator are not moved back to the top, they are seen in push order
+    rather than in the order of the execution frames, and a generator must
+    be resumed in the thread where it established its items.
+    """
+
+    def __init__(self):
+        self._local = _LocalTop()
+
+    def __len__(self):
+        count = 0
+        node = self._local.top
+        while node is not None:
+            count += 1
+            node = node.next
+        return count
+
+    def clear(self):
+        self._local.top = None
+
+    def push(self,item,offset=0):
+        """Push the given item onto the stack for the current thread.
 
+        If 'offset' is given, it is the number of execution frames to skip
+        backwards to find the frame that owns the item.
+        """
+        frame = _getframe(offset+1)
+        #  This is an inlined version of _in_generator(frame).
+        try:
+            in_generator = bool(frame.f_code.co_flags & CO_GENERATOR)
+        except AttributeError:
+            in_generator = False
+        self._local.top = _Entry(item,frame,self._local.top,in_generator)
+
+    def pop(self):
+        """Pop the innermost item owned by the current execution frame.
+
+        IndexError is raised if no item is owned by the current frame or by
+        any of its callers.
+        """
+        node = self._local.top
+        if node is None:
+            raise IndexError("stack is empty")
+        #  The owner is usually the caller, or the with-statement calling
+        #  an __exit__ method that pops its item.
+        frame = _getframe(1)
+        owner = node.frame
+        if owner is frame.f_back or owner is frame or owner is None or \
+           _on_chain(owner,frame):
+            self._local.top = node.next
+            return
+        prefix = []
+        target = node
+        while target is not None:
+            if target.frame is None or _on_chain(target.frame,frame):
+                break
+            prefix.append(target)
+            target = target.next
+        else:
+            raise IndexError("stack has no items for the current frame")
+        self._local.top = _rebuild(prefix,target.next)
+
+    def _visible_entries(self,node):
+        """Get list of entries not owned by suspended generators."""
+        entries = []
+        while node is not None:
+            if not _is_suspended(node):
+                entries.append(node)
+            node = node.next
+        return entries
+
+    def items(self):
+        """Iterator over stack of items for the current thread."""
+        node = self._local.top
+        while node is not None:
+            if not _is_suspended(node):
+                yield node.item
+            node = node.next
+
+    def memo(self):
+        """Get a dict for memoising results computed from the current items.
+
+        The dict is attached to the top entry of the stack, so it is only
+        seen while that entry remains on top.  None is returned if the
+        stack is empty, or if some of its items belong to generators and
+        so might be hidden or revealed without a push or pop.
+        """
+        node = self._local.top
+        if node is None or node.ngen:
+            return None
+        memo = node.memo
+        if memo is None:
+            memo = node.memo = {}
+        return memo
+
+    def find(self,key,lookup,stamp=None):
+        """Find the value for 'key' provided by the innermost item.
+
+        This behaves exactly like CallStack.find(), memoising results on
+        the entries of the stack unless some of them belong to generators.
+        """
+        node = self._local.top
+        if node is None:
+            return None
+        if node.ngen:
+            for entry in self._visible_entries(node):
+                value = lookup(entry.item,key)
+                if value is not None:
+                    return value
+            return None
+        return _find_memoised(node,key,lookup,stamp)
+
+    def snapshot(self):
+        """Get an immutable snapshot of the items for the current thread.
+
+        Since the stack is already an immutable linked list, this simply
+        returns its top entry, unless some items must be hidden because
+        they belong to suspended generators.
+        """
+        node = self._local.top
+        if node is None or not node.ngen:
+            return node
+        snapshot = None
+        for entry in reversed(self._visible_entries(node)):
+            snapshot = _Entry(entry.item,None,snapshot)
+        return snapshot
+
+    def swap(self,top):
+        """Replace the stack for the current thread with the given snapshot.
+
+        The previous top of the stack is returned, and can be passed back
+        to swap() to restore it.
+        """
+        old_top = self._local.top
+        self._local.top = top
+        return old_top
+
+    def resume(self,segment,frame):
+        """Swap in the saved items of a generator that is about to resume.
+
+        This behaves exactly like CallStack.resume().
+        """
+        base = self._local.top
+        if segment is not None:
+            self._local.top = _rebase(segment[0],segment[1],base)
+        return base
+
+    def suspend(self,base):
+        """Swap out the items of a generator that has just yielded.
+
+        This behaves exactly like CallStack.suspend().
+        """
+        top = self._local.top
+        self._local.top = base
+        if top is base:
+            return None
+        return (top,base)
+
+    def sweep(self):
+        """Drop entries that can never be seen again.
+
+        This engine never drops entries; the stack of a thread that has
+        died is released along with its thread-local storage.
+        """
+        return 0
+
+    def stats(self):
+        """Get a dict counting the live and reclaimed entries.
+
+        This has the same keys as CallStack.stats(), but the live entries
+        are only counted for the current thread.
+        """
+        return {"live": len(self), "reclaimed": 0}
+
+
+#  Available engines, by name.
+ENGINES = {
+    "frame": CallStack,
+    "context": ContextCallStack,
+}
+
+
+def get_engine(name=None):
+    """Get the CallStack engine class with the given name.
+
+    If no name is given, it is taken from the environment variable
+    WITHRESTART_CALLSTACK and defaults to "frame".
+    """
+    if name is None:
+        name = os.environ.get("WITHRESTART_CALLSTACK","frame")
+    try:
+        return ENGINES[name]
+    except KeyError:
+        raise ValueError("unknown CallStack engine: %r" % (name,))
 
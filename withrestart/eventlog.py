@@ -0,0 +1,214 @@
+"""
+
+  withrestart.eventlog:  buffered log of error-recovery actions
+
+This module provides EventLog, which writes a record of every recovery
+action to a local append-only file for later analysis:
+
+    with EventLog("/var/log/myapp/recovery.log"):
+        ... run the program ...
+
+Two kinds of record are written, one JSON object per line:
+
+    * "dispatch" records give the type of an error that was dispatched to
+      the handlers, the handlers that were consulted, the restart that they
+      chose (or null) and the time taken by the handlers, in seconds.
+    * "restart" records give the name of a restart that was invoked, a
+      summary of its arguments and the time taken by the restart function.
+
+Every record also has the wall-clock time "t" at which it was made.  The
+records are collected using the HANDLER_DISPATCH and INVOKE_RESTART hooks
+from withrestart.monitoring, and the hooks only append them to an in-memory
+ring buffer.  A background thread formats the buffered records and writes
+them out in batches.  If records arrive faster than they can be written, the
+oldest are dropped rather than blocking the program; the number dropped is
+kept in the 'dropped' attribute.
+When the file grows beyond 'max_bytes' it is rotated in the same way as by
+logging.handlers.RotatingFileHandler, keeping 'backup_count' old files.
+
+"""
+
+import os
+import time
+import json
+import threading
+from collections import deque
+
+from withrestart import monitoring
+from withrestart import Handler, HandlerSuite, FrozenHandlerSuite
+
+
+_DISPATCH = "dispatch"
+_RESTART = "restart"
+
+
+def _describe_handler(handler):
+    """Get a short description of an established handler."""
+    if isinstance(handler,Handler):
+        func = handler.func
+        if isinstance(func,basestring):
+            return func
+        return getattr(func,"__name__",type(func).__name__)
+    if isinstance(handler,(HandlerSuite,FrozenHandlerSuite,)):
+        return "[%s]" % (",".join(_describe_handler(h)
+                                  for h in handler.handlers),)
+    return type(handler).__name__
+
+
+def _summarise(value,length=60):
+    """Get a repr of the given value, truncated to the given length."""
+    try:
+        text = repr(value)
+    except Exception:
+        text = "<%s>" % (type(value).__name__,)
+    if len(text) > length:
+        text = text[:length-3] + "..."
+    return text
+
+
+class EventLog(object):
+    """Buffered, rotating log of error-recovery actions.
+
+    Records are buffered in memory, holding at most 'capacity' of them, and
+    written out by a background thread every 'interval' seconds.  Call
+    start() and stop() to begin and end logging, or use the EventLog as a
+    context manager.  Call flush() to write out buffered records at once.
+    """
+
+    def __init__(self,path,capacity=10000,interval=1.0,
+                 max_bytes=10*1024*1024,backup_count=5):
+        self.path = path
+        self.capacity = capacity
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.dropped = 0
+        self._buffer = deque(maxlen=capacity)
+        self._write_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._file = None
+
+    def start(self):
+        """Start recording recovery actions and writing them out."""
+        self._stopping.clear()
+        monitoring.register(monitoring.HANDLER_DISPATCH,self._on_dispatch)
+        monitoring.register(monitoring.INVOKE_RESTART,self._on_restart)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop recording, write out any buffered records and close the file.
+        """
+        if self._thread is None:
+            return
+        monitoring.unregister(monitoring.HANDLER_DISPATCH,self._on_dispatch)
+        monitoring.unregister(monitoring.INVOKE_RESTART,self._on_restart)
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        self.flush()
+        self._write_lock.acquire()
+        try:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        finally:
+            self._write_lock.release()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.stop()
+
+    def _append(self,record):
+        #  deque.append() is atomic, and discards the oldest record when the
+        #  buffer is full; the count of dropped records is only a guide.
+        if len(self._buffer) >= self.capacity:
+            self.dropped += 1
+        self._buffer.append(record)
+
+    def _on_dispatch(self,event,target,error,start,duration):
+        #  The handlers are only described when the record is formatted.
+        self._append((_DISPATCH,time.time(),error.__class__,
+                      monitoring.dispatched_handlers(),target,duration))
+
+    def _on_restart(self,event,target,error,start,duration):
+        self._append((_RESTART,time.time(),target.restart.name,target.args,
+                      target.kwds,duration))
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._stopping.wait(self.interval)
+            self.flush()
+
+    def flush(self):
+        """Write out all buffered records."""
+        #  Records are taken from the buffer and written under the same lock,
+        #  so that batches written by different threads can't be reordered.
+        self._write_lock.acquire()
+        try:
+            lines = []
+            buffer = self._buffer
+            while True:
+                try:
+                    record = buffer.popleft()
+                except IndexError:
+                    break
+                lines.append(self._format(record))
+            if lines:
+                self._write("".join(lines))
+        finally:
+            self._write_lock.release()
+
+    def _format(self,record):
+        if record[0] is _DISPATCH:
+            (kind,t,exc_type,handlers,target,duration) = record
+            if target is None:
+                restart = None
+            else:
+                restart = target.restart.name
+            fields = {"event": kind, "t": t, "error": exc_type.__name__,
+                      "handlers": [_describe_handler(h) for h in handlers],
+                      "restart": restart, "duration": duration}
+        else:
+            (kind,t,name,args,kwds,duration) = record
+            summary = [_summarise(arg) for arg in args]
+            for (key,value) in sorted(kwds.iteritems()):
+                summary.append("%s=%s" % (key,_summarise(value)))
+            fields = {"event": kind, "t": t, "restart": name,
+                      "args": summary, "duration": duration}
+        return json.dumps(fields,sort_keys=True,separators=(",",":")) + "\n"
+
+    def _write(self,data):
+        if self._file is None:
+            self._file = open(self.path,"ab")
+        size = os.fstat(self._file.fileno()).st_size
+        if size and self.max_bytes and size + len(data) > self.max_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+
+    def _rotate(self):
+        """Rotate the log files, in the manner of RotatingFileHandler."""
+        self._file.close()
+        self._file = None
+        if self.backup_count > 0:
+            for i in xrange(self.backup_count - 1,0,-1):
+                src = "%s.%d" % (self.path,i)
+                if os.path.exists(src):
+                    dst = "%s.%d" % (self.path,i + 1)
+                    if os.path.exists(dst):
+                        os.remove(dst)
+                    os.rename(src,dst)
+            dst = self.path + ".1"
+            if os.path.exists(dst):
+                os.remove(dst)
+            os.rename(self.path,dst)
+        else:
+            os.remove(self.path)
+        self._file = open(self.path,"ab")
+
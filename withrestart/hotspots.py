@@ -0,0 +1,217 @@
+"""
+
+  withrestart.hotspots:  statistics on where recovered errors come from
+
+This module provides an opt-in profiler that records the code location at
+which each error dispatched to the handlers was raised.  Errors are counted
+when they pass through RestartSuite.__exit__, RestartSuite.__call__ or the
+invoke() function, and the location is taken from the innermost frame of
+the error's traceback:
+
+    withrestart.hotspots.enable()
+    ... run the program ...
+    print withrestart.hotspots.format_report()
+
+For each location the profiler counts the errors raised there, the restarts
+that the handlers chose for them, and the total time spent recovering from
+them.  The recovery time covers both the handlers and the restart that they
+chose, and the part spent in the handlers is also reported separately.
+Counters are kept in a dict indexed by code object and line number, so the
+cost of recording an error is a dict lookup and a few additions; while the
+profiler is disabled, the only cost is a single check for each error.
+
+"""
+
+import threading
+from collections import namedtuple
+from timeit import default_timer
+
+import withrestart
+from withrestart import InvokeRestart
+
+
+#  A single line of the report produced by HotspotProfiler.report().
+Hotspot = namedtuple("Hotspot",
+                     "filename lineno function count time handler_time "
+                     "restarts")
+
+
+class _Site(object):
+    """Counters for errors raised at a single code location."""
+
+    __slots__ = ("count","handler_time","restart_time","restarts",)
+
+    def __init__(self):
+        self.count = 0
+        self.handler_time = 0.0
+        self.restart_time = 0.0
+        self.restarts = {}
+
+
+class _TimedInvokeRestart(InvokeRestart):
+    """InvokeRestart that adds the time taken by its restart to a site."""
+
+    __slots__ = ("profiler","key",)
+
+    def __init__(self,profiler,key,e):
+        InvokeRestart.__init__(self,e.restart,*e.args,**e.kwds)
+        self.profiler = profiler
+        self.key = key
+
+    def invoke(self):
+        start = default_timer()
+        try:
+            return InvokeRestart.invoke(self)
+        finally:
+            self.profiler._add_restart_time(self.key,default_timer() - start)
+
+
+class HotspotProfiler(object):
+    """Profiler recording the locations of errors dispatched to handlers.
+
+    An instance can be enabled by passing it to enable(), or used directly
+    by calling its profile() method from a dispatch hook.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sites = {}
+
+    def profile(self,dispatch,err,attempt,traceback):
+        """Call dispatch(err,attempt), recording the outcome for the error.
+
+        The location is taken from the innermost frame of the traceback.
+        The name of the restart chosen by the handlers is recorded, or None
+        if they did not choose one, along with the time taken by dispatch().
+        The InvokeRestart is re-raised as one that also records the time
+        taken by the restart, whenever it is invoked.
+        """
+        start = default_timer()
+        try:
+            dispatch(err,attempt)
+        except InvokeRestart, e:
+            key = self.record(traceback,e.restart.name,default_timer()-start)
+            raise _TimedInvokeRestart(self,key,e)
+        self.record(traceback,None,default_timer() - start)
+
+    def record(self,traceback,restart,duration):
+        """Record an error raised at the innermost frame of a traceback.
+
+        The 'duration' is the time spent in the handlers.  The key for the
+        location is returned.
+        """
+        while traceback.tb_next is not None:
+            traceback = traceback.tb_next
+        key = (traceback.tb_frame.f_code,traceback.tb_lineno)
+        self._lock.acquire()
+        try:
+            try:
+                site = self._sites[key]
+            except KeyError:
+                site = self._sites[key] = _Site()
+            site.count += 1
+            site.handler_time += duration
+            site.restarts[restart] = site.restarts.get(restart,0) + 1
+        finally:
+            self._lock.release()
+        return key
+
+    def _add_restart_time(self,key,duration):
+        """Add the time taken by a restart to the site with the given key."""
+        self._lock.acquire()
+        try:
+            site = self._sites.get(key)
+            if site is not None:
+                site.restart_time += duration
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        """Discard all recorded statistics."""
+        self._lock.acquire()
+        try:
+            self._sites = {}
+        finally:
+            self._lock.release()
+
+    def report(self):
+        """Get a list of Hotspot tuples, most frequent location first.
+
+        Each tuple gives the filename, line number and function name of
+        the location, the number of errors raised there, the total time in
+        seconds spent recovering from them, the part of that time spent in
+        the handlers, and a dict counting the restarts chosen for them (with
+        None counting errors left unhandled).
+        """
+        self._lock.acquire()
+        try:
+            items = [(key,site.count,site.handler_time,site.restart_time,
+                      dict(site.restarts))
+                     for (key,site) in self._sites.iteritems()]
+        finally:
+            self._lock.release()
+        report = []
+        for ((code,lineno),count,handler_time,restart_time,restarts) in items:
+            report.append(Hotspot(code.co_filename,lineno,code.co_name,count,
+                                  handler_time + restart_time,handler_time,
+                                  restarts))
+        report.sort(key=lambda h: (-h.count,-h.time,h.filename,h.lineno))
+        return report
+
+    def format_report(self,limit=None):
+        """Get the report as a human-readable table.
+
+        If 'limit' is given, only that many locations are included.
+        """
+        lines = ["%8s %10s %10s  %-40s %s" % ("count","time","handlers",
+                                               "location","restarts")]
+        for h in self.report()[:limit]:
+            location = "%s:%d(%s)" % (h.filename,h.lineno,h.function)
+            restarts = ", ".join("%s=%d" % (name,n) for (name,n)
+                                 in sorted(h.restarts.iteritems(),
+                                           key=lambda item: -item[1]))
+            lines.append("%8d %10.6f %10.6f  %-40s %s" % (h.count,h.time,
+                                                          h.handler_time,
+                                                          location,restarts))
+        return "\n".join(lines)
+
+
+#  The profiler used by the module-level functions.
+profiler = HotspotProfiler()
+
+
+def enable(prof=None):
+    """Start recording the locations of errors dispatched to handlers.
+
+    Statistics are recorded by the given HotspotProfiler, or by the one
+    stored in this module's 'profiler' attribute if none is given.
+    """
+    if prof is None:
+        prof = profiler
+    withrestart._profiler = prof
+
+
+def disable():
+    """Stop recording the locations of errors dispatched to handlers."""
+    withrestart._profiler = None
+
+
+def is_enabled():
+    """Check whether a profiler is currently recording errors."""
+    return withrestart._profiler is not None
+
+
+def reset():
+    """Discard the statistics recorded by the module-level profiler."""
+    profiler.reset()
+
+
+def report():
+    """Get the report from the module-level profiler."""
+    return profiler.report()
+
+
+def format_report(limit=None):
+    """Get the report from the module-level profiler as a table."""
+    return profiler.format_report(limit)
+
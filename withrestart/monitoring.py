@@ -0,0 +1,261 @@
+"""
+
+  withrestart.monitoring:  hooks for observing error-recovery events
+
+This module provides a registry of callbacks that are fired as the restart
+machinery does its work.  It is loosely modelled on sys.monitoring; register
+a callback for one of the following events to be told when it occurs:
+
+    * CONTEXT_ENTER:    a RestartSuite, Handler or HandlerSuite was entered
+    * CONTEXT_EXIT:     a RestartSuite, Handler or HandlerSuite was exited
+    * HANDLER_DISPATCH: handlers were run in response to an error
+    * INVOKE_RESTART:   a handler invoked a restart via InvokeRestart
+    * EXIT_RESTART:     a restart exited its context via ExitRestart
+    * RETRY_LAST_CALL:  a restart asked to retry via RetryLastCall
+    * RAISE_NEW_ERROR:  a restart raised a new error via RaiseNewError
+
+Callbacks are called as callback(event,target,error,start,duration) where
+'target' is the object the event relates to, 'error' is the exception being
+handled (if any), 'start' is the time at which the operation began according
+to timeit.default_timer(), and 'duration' is the time it took in seconds:
+
+    * for CONTEXT_ENTER and CONTEXT_EXIT, the target is the context object
+      and the duration is the time spent entering or exiting it.  When a
+      context is exited due to an error, this includes running its handlers.
+    * for HANDLER_DISPATCH, the target is the InvokeRestart chosen by the
+      handlers, or None if no handler invoked a restart.  The handlers that
+      were consulted can be obtained by calling dispatched_handlers().
+    * for INVOKE_RESTART, the target is the InvokeRestart being processed
+      and the duration is the time spent running the restart function.
+    * for EXIT_RESTART, RETRY_LAST_CALL and RAISE_NEW_ERROR, the target is
+      the Restart that caused the event; for RAISE_NEW_ERROR the error is
+      the new error to be raised.
+
+Hooks are implemented by replacing methods of the withrestart classes with
+instrumented versions when the first callback is registered for an event,
+and restoring the originals when the last callback for it is unregistered.
+Only the methods needed for events with registered callbacks are replaced;
+for example, registering for HANDLER_DISPATCH leaves the entering and
+exiting of contexts untouched.  When no callbacks are registered the restart
+machinery therefore runs exactly as if this module did not exist.
+Exceptions raised by callbacks are propagated.
+
+"""
+
+import threading
+from timeit import default_timer
+
+import withrestart
+from withrestart import Restart, RestartSuite, Handler, HandlerSuite
+from withrestart import FrozenRestartSuite, FrozenHandlerSuite
+from withrestart import InvokeRestart, ExitRestart, RetryLastCall
+from withrestart import RaiseNewError
+
+
+CONTEXT_ENTER = "context_enter"
+CONTEXT_EXIT = "context_exit"
+HANDLER_DISPATCH = "handler_dispatch"
+INVOKE_RESTART = "invoke_restart"
+EXIT_RESTART = "exit_restart"
+RETRY_LAST_CALL = "retry_last_call"
+RAISE_NEW_ERROR = "raise_new_error"
+
+EVENTS = (CONTEXT_ENTER,CONTEXT_EXIT,HANDLER_DISPATCH,INVOKE_RESTART,
+          EXIT_RESTART,RETRY_LAST_CALL,RAISE_NEW_ERROR,)
+
+
+_lock = threading.Lock()
+_callbacks = dict((event,()) for event in EVENTS)
+_originals = {}  # maps each installed group to its replaced methods
+_dispatching = threading.local()  # handlers of the dispatch being reported
+
+
+def register(event,callback):
+    """Register a callback to be fired for the given event."""
+    if event not in _callbacks:
+        raise ValueError("unknown event: %r" % (event,))
+    _lock.acquire()
+    try:
+        _callbacks[event] = _callbacks[event] + (callback,)
+        _update()
+    finally:
+        _lock.release()
+
+
+def unregister(event,callback):
+    """Unregister a callback previously registered for the given event.
+
+    If no callbacks remain registered for the event, the instrumented
+    versions of the withrestart methods that it needs are removed.
+    """
+    _lock.acquire()
+    try:
+        callbacks = list(_callbacks[event])
+        callbacks.remove(callback)
+        _callbacks[event] = tuple(callbacks)
+        _update()
+    finally:
+        _lock.release()
+
+
+def is_active():
+    """Check whether the instrumented methods are currently installed."""
+    return bool(_originals)
+
+
+def dispatched_handlers():
+    """Get the handlers consulted by the dispatch currently being reported.
+
+    When called from a HANDLER_DISPATCH callback, this returns a tuple of
+    the handlers that were run for the error, innermost first.  At other
+    times it returns None.
+    """
+    return getattr(_dispatching,"handlers",None)
+
+
+def _emit(event,target,error,start,duration):
+    for callback in _callbacks[event]:
+        callback(event,target,error,start,duration)
+
+
+def _emit_dispatch(target,error,consulted,start,duration):
+    _dispatching.handlers = tuple(consulted)
+    try:
+        _emit(HANDLER_DISPATCH,target,error,start,duration)
+    finally:
+        _dispatching.handlers = None
+
+
+def _traced_enter(cls):
+    orig_enter = cls.__dict__["__enter__"]
+    def __enter__(self):
+        start = default_timer()
+        #  Tell the original method about our extra frame, so that the
+        #  context is attributed to the frame of the with-statement.
+        result = orig_enter(self,2)
+        _emit(CONTEXT_ENTER,result,None,start,default_timer()-start)
+        return result
+    return __enter__
+
+
+def _traced_exit(cls):
+    orig_exit = cls.__dict__["__exit__"]
+    def __exit__(self,exc_type,exc_value,traceback,**kwds):
+        #  RestartSuite calls __exit__ internally to re-handle new errors;
+        #  these calls are part of a single exit and are not reported.
+        if kwds.get("internal"):
+            return orig_exit(self,exc_type,exc_value,traceback,**kwds)
+        start = default_timer()
+        try:
+            return orig_exit(self,exc_type,exc_value,traceback)
+        finally:
+            _emit(CONTEXT_EXIT,self,exc_value,start,default_timer()-start)
+    return __exit__
+
+
+def _traced_dispatch(orig_dispatch,is_method):
+    def _dispatch_handlers(*args):
+        if is_method:
+            err = args[1]
+        else:
+            err = args[0]
+        #  The original records the handlers it runs in this list.
+        consulted = []
+        start = default_timer()
+        try:
+            orig_dispatch(*(args + (consulted,)))
+        except InvokeRestart, e:
+            _emit_dispatch(e,err,consulted,start,default_timer()-start)
+            raise
+        _emit_dispatch(None,err,consulted,start,default_timer()-start)
+    return _dispatch_handlers
+
+
+def _traced_invoke(orig_invoke):
+    def invoke(self):
+        start = default_timer()
+        try:
+            try:
+                return orig_invoke(self)
+            except ExitRestart:
+                _emit(EXIT_RESTART,self.restart,None,start,
+                      default_timer()-start)
+                raise
+            except RetryLastCall:
+                _emit(RETRY_LAST_CALL,self.restart,None,start,
+                      default_timer()-start)
+                raise
+            except RaiseNewError, e:
+                _emit(RAISE_NEW_ERROR,self.restart,e.error,start,
+                      default_timer()-start)
+                raise
+        finally:
+            _emit(INVOKE_RESTART,self,None,start,default_timer()-start)
+    return invoke
+
+
+def _install_enter(replace):
+    for cls in (RestartSuite,Handler,HandlerSuite,
+                Restart,FrozenRestartSuite,FrozenHandlerSuite):
+        replace(cls,"__enter__",_traced_enter(cls))
+
+
+def _install_exit(replace):
+    #  The others delegate __exit__ to the suite they pushed in __enter__.
+    for cls in (RestartSuite,Handler,HandlerSuite):
+        replace(cls,"__exit__",_traced_exit(cls))
+
+
+def _install_dispatch(replace):
+    orig = RestartSuite.__dict__["_dispatch_handlers"]
+    replace(RestartSuite,"_dispatch_handlers",_traced_dispatch(orig,True))
+    orig = withrestart._dispatch_handlers
+    replace(withrestart,"_dispatch_handlers",_traced_dispatch(orig,False))
+
+
+def _install_invoke(replace):
+    orig = InvokeRestart.__dict__["invoke"]
+    replace(InvokeRestart,"invoke",_traced_invoke(orig))
+
+
+#  The groups of instrumented methods, and the events that need each one.
+_GROUPS = (
+    (_install_enter,(CONTEXT_ENTER,)),
+    (_install_exit,(CONTEXT_EXIT,)),
+    (_install_dispatch,(HANDLER_DISPATCH,)),
+    (_install_invoke,(INVOKE_RESTART,EXIT_RESTART,RETRY_LAST_CALL,
+                      RAISE_NEW_ERROR,)),
+)
+
+
+def _update():
+    """Install or uninstall each group of instrumented methods as needed."""
+    for (install,events) in _GROUPS:
+        for event in events:
+            if _callbacks[event]:
+                if install not in _originals:
+                    _install(install)
+                break
+        else:
+            if install in _originals:
+                _uninstall(install)
+
+
+def _install(install):
+    """Replace a group of withrestart methods with instrumented versions."""
+    originals = _originals[install] = {}
+    def replace(obj,name,value):
+        try:
+            orig = obj.__dict__[name]
+        except KeyError:
+            orig = getattr(obj,name)
+        originals[(obj,name)] = orig
+        setattr(obj,name,value)
+    install(replace)
+
+
+def _uninstall(install):
+    """Restore a group of original, uninstrumented withrestart methods."""
+    for ((obj,name),orig) in _originals.pop(install).iteritems():
+        setattr(obj,name,orig)
+
@@ -0,0 +1,342 @@
+"""
+
+  withrestart.policies:  retry policies with backoff and circuit breaking
+
+This module provides RetryPolicy, a handler function that invokes the
+"retry" restart after waiting for an exponentially increasing delay, and
+CircuitBreaker, which stops calls to a failing dependency altogether once
+it has failed too often:
+
+    breaker = CircuitBreaker(failure_threshold=5,reset_timeout=30)
+    fetch = breaker.guard(urllib2.urlopen)
+
+    def readurl(url):
+        with restarts(retry,use_value) as invoke:
+            return invoke(fetch,url).read()
+
+    policy = RetryPolicy(max_attempts=4,base_delay=0.5,jitter=0.5,
+                         breaker=breaker,fallback=("use_value",""))
+    with Handler(IOError,policy):
+        with Handler(CircuitOpenError,"use_value",""):
+            data = readurl(url)
+
+Each failed call is retried until the policy's attempt budget for that call
+is used up, and the fallback restart is invoked after that.  While the
+breaker is open, guarded functions raise CircuitOpenError without being
+called, and the policy invokes its fallback without waiting.  A breaker
+can be shared by any number of call sites and threads.
+
+It also provides DecisionCache, which wraps a handler function so that the
+restart it chooses for an error is remembered, and invoked straight away
+for later errors with the same key:
+
+    def diagnose(err):
+        ... expensive investigation of err ...
+        raise InvokeRestart("use_value",replacement)
+
+    with Handler(IOError,DecisionCache(diagnose,key=lambda e: e.filename)):
+        data = readall(dirname)
+
+These classes take a 'clock' argument, which must provide time() and sleep()
+methods.  It defaults to one using the functions from the time module, and
+can be replaced with a fake clock for testing.
+
+"""
+
+import time
+import random
+import threading
+from collections import OrderedDict
+
+from withrestart import Restart, InvokeRestart, current_attempt
+
+
+class _SystemClock(object):
+    """Clock using the functions from the time module."""
+    def time(self):
+        return time.time()
+    def sleep(self,seconds):
+        time.sleep(seconds)
+
+_system_clock = _SystemClock()
+_random = random.Random()
+
+
+class CircuitOpenError(Exception):
+    """Exception raised by a guarded function while its breaker is open."""
+    pass
+
+
+class CircuitBreaker(object):
+    """Thread-safe circuit breaker shared by calls to a single dependency.
+
+    The breaker starts out "closed".  After 'failure_threshold' consecutive
+    failures it becomes "open", and calls are refused until 'reset_timeout'
+    seconds have passed.  It is then "half-open": a single trial call is
+    allowed through, which closes the breaker if it succeeds and re-opens
+    it if it fails.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self,failure_threshold=5,reset_timeout=60,clock=None):
+        if clock is None:
+            clock = _system_clock
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        """The current state of the breaker."""
+        self._lock.acquire()
+        try:
+            return self._current_state()
+        finally:
+            self._lock.release()
+
+    def _current_state(self):
+        if self._state == self.OPEN:
+            if self.clock.time() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                self._trial = False
+        return self._state
+
+    def is_open(self):
+        """Check whether calls would currently be refused.
+
+        Unlike allow(), this does not claim the trial call of a half-open
+        breaker, so it's suitable for deciding whether to wait and retry.
+        """
+        self._lock.acquire()
+        try:
+            state = self._current_state()
+            return state == self.OPEN or (state == self.HALF_OPEN and
+                                          self._trial)
+        finally:
+            self._lock.release()
+
+    def allow(self):
+        """Check whether a call may go ahead, claiming it if so.
+
+        Every call that is allowed must be followed by a call to either
+        record_success() or record_failure().
+        """
+        self._lock.acquire()
+        try:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return False
+        finally:
+            self._lock.release()
+
+    def record_success(self):
+        """Record a successful call, closing the breaker."""
+        self._lock.acquire()
+        try:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._trial = False
+        finally:
+            self._lock.release()
+
+    def record_failure(self):
+        """Record a failed call, opening the breaker if necessary."""
+        self._lock.acquire()
+        try:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or \
+               self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = self.clock.time()
+                self._trial = False
+        finally:
+            self._lock.release()
+
+    def guard(self,func):
+        """Wrap a function so that its calls go through this breaker.
+
+        The returned function raises CircuitOpenError without calling
+        'func' while the breaker is open, and records the outcome of each
+        call that it does make.
+        """
+        def guarded(*args,**kwds):
+            return self.call(func,*args,**kwds)
+        guarded.__name__ = func.__name__
+        guarded.__doc__ = func.__doc__
+        return guarded
+
+    def call(self,func,*args,**kwds):
+        """Call func(*args,**kwds) through this breaker."""
+        if not self.allow():
+            raise CircuitOpenError(func)
+        try:
+            result = func(*args,**kwds)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+
+class RetryPolicy(object):
+    """Handler function retrying failed calls with exponential backoff.
+
+    When called with an error, this waits and then invokes the "retry"
+    restart.  The delay before attempt n+1 is base_delay*multiplier**(n-1),
+    capped at 'max_delay'; if 'jitter' is given, a random fraction of up to
+    'jitter' of the delay is taken off it, so that clients which failed
+    together don't all retry together.
+
+    Once 'max_attempts' attempts at a call have failed, or if 'breaker' is
+    given and is open, the 'fallback' restart is invoked instead.  It may
+    be the name of a restart, or a tuple giving the name and arguments.  If
+    no fallback is given the error is left to other handlers.
+    """
+
+    def __init__(self,max_attempts=5,base_delay=0.1,multiplier=2,
+                 max_delay=30,jitter=0,breaker=None,fallback=None,
+                 clock=None,random=None):
+        if clock is None:
+            clock = _system_clock
+        if random is None:
+            random = _random
+        if isinstance(fallback,basestring):
+            fallback = (fallback,)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.multiplier = multiplier
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.breaker = breaker
+        self.fallback = fallback
+        self.clock = clock
+        self.random = random
+
+    def delay(self,attempt):
+        """Get the time to wait after the given attempt has failed."""
+        delay = self.base_delay * self.multiplier ** (attempt - 1)
+        delay = min(delay,self.max_delay)
+        if self.jitter:
+            delay -= delay * self.jitter * self.random.random()
+        return delay
+
+    def __call__(self,err):
+        attempt = current_attempt() or 1
+        if attempt >= self.max_attempts or \
+           (self.breaker is not None and self.breaker.is_open()):
+            if self.fallback is not None:
+                raise InvokeRestart(*self.fallback)
+            return
+        self.clock.sleep(self.delay(attempt))
+        raise InvokeRestart("retry")
+
+
+class DecisionCache(object):
+    """Handler function that remembers the decisions of another.
+
+    This wraps the handler function 'func', calling key(err) for each error
+    it is asked to handle.  The first time a key is seen, 'func' is called
+    and its decision is remembered: either the name of the restart that it
+    invoked along with the arguments, or that it declined to invoke one.
+    Later errors with the same key replay that decision without calling
+    'func' at all.  If key(err) returns None, the decision is not cached.
+
+    At most 'maxsize' decisions are kept, evicting the least recently used,
+    and if 'ttl' is given each decision expires that many seconds after it
+    was made.  To cache the decisions of a whole suite of handlers, wrap
+    its handle_error method: Handler(suite.exc_type,DecisionCache(...)).
+
+    The attributes 'hits' and 'misses' count the errors that were handled
+    with and without a cached decision.
+    """
+
+    def __init__(self,func,key,maxsize=128,ttl=None,clock=None):
+        if clock is None:
+            clock = _system_clock
+        self.func = func
+        self.key = key
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._decisions = OrderedDict()
+
+    def __call__(self,err,*args,**kwds):
+        key = self.key(err)
+        if key is None:
+            return self.func(err,*args,**kwds)
+        now = self.clock.time()
+        self._lock.acquire()
+        try:
+            try:
+                (decision,expires) = self._decisions.pop(key)
+            except KeyError:
+                found = False
+            else:
+                found = expires is None or expires > now
+                if found:
+                    self._decisions[key] = (decision,expires)
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        finally:
+            self._lock.release()
+        if found:
+            if decision is not None:
+                (name,args,kwds) = decision
+                raise InvokeRestart(name,*args,**kwds)
+            return
+        try:
+            self.func(err,*args,**kwds)
+        except InvokeRestart, e:
+            restart = e.restart
+            if isinstance(restart,Restart):
+                restart = restart.name
+            self._remember(key,(restart,e.args,e.kwds),now)
+            raise
+        self._remember(key,None,now)
+
+    def _remember(self,key,decision,now):
+        if self.ttl is None:
+            expires = None
+        else:
+            expires = now + self.ttl
+        self._lock.acquire()
+        try:
+            self._decisions.pop(key,None)
+            self._decisions[key] = (decision,expires)
+            while len(self._decisions) > self.maxsize:
+                self._decisions.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._decisions)
+
+    def clear(self):
+        """Forget all cached decisions."""
+        self._lock.acquire()
+        try:
+            self._decisions.clear()
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """Get a dict with the number of hits, misses and cached decisions."""
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._decisions)}
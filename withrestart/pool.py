@@ -0,0 +1,401 @@
+"""
+
+  withrestart.pool:  worker pools that respect the restart protocol
+
+This module provides ProcessPool, a simple pool of worker processes that
+keeps the restart protocol intact across the process boundary.  Functions
+run in the workers establish restarts as usual, while the handlers that
+decide how to recover from their errors are established in the parent:
+
+    def readfile(filepath):
+        with restarts(use_value) as invoke:
+            return invoke(open,filepath).read()
+
+    with ProcessPool(4) as pool:
+        with Handler(IOError,"use_value",""):
+            data = pool.map(readfile,filepaths,restarts=(skip,))
+
+When a function running in a worker raises an error that isn't handled by
+the worker itself, the error is sent to the parent along with the names of
+the restarts established in the worker.  The parent runs its handlers with
+stand-ins for those restarts established, and sends the chosen restart back
+to the worker, which invokes its own copy of the restart to continue.
+
+The messages passed between parent and worker are plain picklable tuples.
+A restart decision is either None, meaning that no restart was invoked,
+or a tuple (name,args,kwds) giving the name of the chosen restart and the
+arguments with which it is to be invoked.
+
+Functions, items, errors, results and restart arguments must be picklable.
+Errors that cannot be pickled are sent to the parent as a WorkerError.  A
+WorkerError is also raised in the parent if a worker process dies, e.g. by
+crashing or being killed, since the task it was running can never finish.
+
+For work that runs in threads, ThreadPool captures the handlers established
+by the submitting thread and installs them in the worker thread for the
+duration of each task.  The same can be done for any other executor by
+submitting functions wrapped with bind_handlers():
+
+    def readfile(filepath):
+        with restarts(use_value) as invoke:
+            return invoke(open,filepath).read()
+
+    with Handler(IOError,"use_value",""):
+        future = executor.submit(bind_handlers(readfile),filepath)
+
+"""
+
+from __future__ import with_statement
+
+import pickle
+import multiprocessing
+import multiprocessing.pool
+from multiprocessing.queues import SimpleQueue
+
+import withrestart
+from withrestart import Restart, RestartSuite, FrozenRestartSuite, Handler
+from withrestart import RestartError, InvokeRestart
+from withrestart import current_attempt, capture_handlers
+
+
+class WorkerError(Exception):
+    """Exception standing in for an error that could not be pickled.
+
+    The 'exc_type' attribute gives the name of the original exception type,
+    and 'description' its string representation.  If a worker process died
+    without raising an exception, 'exc_type' is None.
+    """
+    def __init__(self,exc_type,description):
+        Exception.__init__(self,exc_type,description)
+        self.exc_type = exc_type
+        self.description = description
+    def __str__(self):
+        if self.exc_type is None:
+            return self.description
+        return "%s: %s" % (self.exc_type,self.description)
+
+
+def _picklable(error):
+    """Get a version of the given error that can be sent to another process."""
+    try:
+        pickle.loads(pickle.dumps(error,pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return WorkerError(type(error).__name__,str(error))
+    return error
+
+
+def _remote_restart(*args,**kwds):
+    """Stand-in for a restart established in a worker process."""
+    raise RestartError("restarts from a worker can only be invoked "
+                       "by raising InvokeRestart")
+
+
+#  The (index,results,decisions) channel used by a worker process.
+_channel = None
+
+#  How long the parent waits for a message before checking that all the
+#  workers are still alive, in seconds.
+_POLL_INTERVAL = 0.1
+
+
+def _worker(index,tasks,results,decisions):
+    """Main loop for worker processes.
+
+    This runs each task with a handler established that forwards errors
+    to the parent process, and sends back a message with its outcome.
+    """
+    global _channel
+    #  Forked workers inherit any contexts established in the parent, but
+    #  all handling of errors must happen on the other side of the channel.
+    withrestart.set_callstack_engine(type(withrestart._cur_restarts))
+    _channel = (index,results,decisions)
+    with Handler(Exception,_ask_parent):
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            (batch,seq,func,item,restarts) = task
+            kind, payload = "skipped", None
+            try:
+                with FrozenRestartSuite(*restarts) as invoke:
+                    payload = invoke(func,item)
+                    kind = "result"
+            except Exception, e:
+                kind, payload = "exception", _picklable(e)
+            try:
+                results.put((index,batch,seq,kind,payload))
+            except Exception, e:
+                results.put((index,batch,seq,"exception",_picklable(e)))
+
+
+def _ask_parent(err):
+    """Handler that forwards errors to the parent process.
+
+    The names of all restarts visible in the worker are sent along with
+    the error, and the restart chosen by the parent's handlers is invoked.
+    """
+    (index,results,decisions) = _channel
+    names = []
+    for suite in withrestart._cur_restarts.items():
+        for r in suite.restarts:
+            if r.name not in names:
+                names.append(r.name)
+    payload = (_picklable(err),names,current_attempt())
+    results.put((index,None,None,"error",payload))
+    decision = decisions.recv()
+    if decision is not None:
+        (name,args,kwds) = decision
+        raise InvokeRestart(name,*args,**kwds)
+
+
+class ProcessPool(object):
+    """Pool of worker processes running functions within restart contexts.
+
+    Errors raised by functions in the workers are handled by the handlers
+    established in the parent process, in the thread consuming the results
+    of map() or imap().  A pool should only be used by one thread at a time.
+    """
+
+    def __init__(self,processes=None,prefetch=None):
+        """ProcessPool initializer.
+
+        The number of worker processes defaults to the number of CPUs.  At
+        most 'prefetch' items (by default, twice the number of processes)
+        are sent to the workers ahead of the results being consumed.
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if prefetch is None:
+            prefetch = 2 * processes
+        self.prefetch = prefetch
+        self._batch = 0
+        self._tasks = SimpleQueue()
+        self._results = SimpleQueue()
+        self._decisions = []
+        self._workers = []
+        for index in xrange(processes):
+            (reader,writer) = multiprocessing.Pipe(duplex=False)
+            w = multiprocessing.Process(target=_worker,
+                                        args=(index,self._tasks,
+                                              self._results,reader))
+            w.daemon = True
+            w.start()
+            self._decisions.append(writer)
+            self._workers.append(w)
+
+    def imap(self,func,iterable,restarts=()):
+        """Lazily invoke the given function on each item in a worker process.
+
+        This is the cross-process equivalent of RestartSuite.imap(): each
+        item is invoked in a worker within a suite of the given restarts,
+        and the results are yielded in order.  Errors are dispatched to the
+        handlers established in the parent; if no restart is invoked for an
+        error, it is re-raised in the parent.
+        """
+        self._batch += 1
+        batch = self._batch
+        items = iter(iterable)
+        exhausted = False
+        submitted = 0
+        consumed = 0
+        done = {}
+        lost = 0
+        try:
+            while True:
+                while not exhausted and submitted - consumed < self.prefetch:
+                    try:
+                        item = items.next()
+                    except StopIteration:
+                        exhausted = True
+                    else:
+                        self._tasks.put((batch,submitted,func,item,restarts))
+                        submitted += 1
+                if consumed in done:
+                    (kind,payload) = done.pop(consumed)
+                    consumed += 1
+                    if kind == "result":
+                        yield payload
+                    elif kind == "exception":
+                        raise payload
+                elif exhausted and consumed == submitted:
+                    break
+                else:
+                    try:
+                        (index,b,seq,kind,payload) = self._get_result()
+                    except WorkerError:
+                        #  The dead worker's task will never finish.
+                        lost += 1
+                        raise
+                    if kind == "error":
+                        self._dispatch(index,*payload)
+                    elif b == batch:
+                        done[seq] = (kind,payload)
+        finally:
+            self._drain(batch,submitted - consumed - len(done) - lost)
+
+    def map(self,func,iterable,restarts=()):
+        """Invoke the given function on each item in a worker process.
+
+        This returns a list of the results produced by imap().
+        """
+        return list(self.imap(func,iterable,restarts))
+
+    def _dispatch(self,index,err,names,attempt):
+        """Run the parent's handlers for an error raised in a worker.
+
+        Stand-ins for the worker's restarts are established while the
+        handlers run, and the restart decision is sent back to the worker.
+        If the decision cannot be sent, the worker is told that no restart
+        was invoked and a RestartError is raised in the parent.
+        """
+        decision = None
+        error = None
+        try:
+            suite = RestartSuite(*[Restart(_remote_restart,name)
+                                   for name in names])
+            with suite:
+                try:
+                    withrestart._invoke_handlers(err,attempt)
+                except InvokeRestart, e:
+                    if e.restart not in suite.restarts:
+                        raise
+                    decision = (e.restart.name,e.args,e.kwds)
+            if decision is not None:
+                try:
+                    pickle.dumps(decision,pickle.HIGHEST_PROTOCOL)
+                except Exception, e:
+                    error = RestartError("arguments for restart '%s' cannot "
+                                         "be sent to a worker: %s"
+                                         % (decision[0],e))
+                    decision = None
+        finally:
+            self._decisions[index].send(decision)
+        if error is not None:
+            raise error
+
+    def _get_result(self):
+        """Wait for the next message from the workers.
+
+        If a worker process has died, the task it was running will never
+        finish, so a WorkerError is raised rather than waiting forever.  The
+        dead worker is forgotten, so the pool can still be used with the
+        remaining workers.
+        """
+        reader = self._results._reader
+        while not reader.poll(_POLL_INTERVAL):
+            if not self._workers:
+                raise WorkerError(None,"all worker processes have died")
+            for w in self._workers:
+                if not w.is_alive():
+                    #  It may have sent a message just before it died.
+                    if reader.poll():
+                        break
+                    self._workers.remove(w)
+                    w.join()
+                    raise WorkerError(None,"worker process %d died with "
+                                           "exit code %s" % (w.pid,w.exitcode))
+        return self._results.get()
+
+    def _drain(self,batch,outstanding):
+        """Wait for outstanding tasks from an abandoned batch to finish.
+
+        Any errors they raise are answered without invoking a restart.  If
+        another worker dies meanwhile then its task will never finish, so
+        the rest are abandoned without waiting any longer.
+        """
+        while outstanding > 0:
+            try:
+                (index,b,seq,kind,payload) = self._get_result()
+            except WorkerError:
+                break
+            if kind == "error":
+                self._decisions[index].send(None)
+            elif b == batch:
+                outstanding -= 1
+
+    def close(self):
+        """Shut down the worker processes, waiting for them to exit."""
+        for _ in self._workers:
+            self._tasks.put(None)
+        for w in self._workers:
+            w.join()
+        for writer in self._decisions:
+            writer.close()
+        self._workers = []
+        self._decisions = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+
+def bind_handlers(func):
+    """Wrap a function to run with the currently-established handlers.
+
+    The handlers are captured when bind_handlers() is called, and are
+    established around each call to the returned function, wherever it
+    happens to be called.  Handlers established by the function itself
+    take precedence over the captured ones, as usual.
+    """
+    handlers = capture_handlers()
+    def run_with_handlers(*args,**kwds):
+        return _run_with_handlers(handlers,func,args,kwds)
+    return run_with_handlers
+
+
+def _run_with_handlers(handlers,func,args,kwds):
+    with handlers:
+        return func(*args,**kwds)
+
+
+class ThreadPool(object):
+    """Pool of worker threads that inherit the submitter's handlers.
+
+    This wraps multiprocessing.pool.ThreadPool so that each task runs with
+    the handlers that were established in the thread that submitted it.
+    """
+
+    def __init__(self,processes=None):
+        self._pool = multiprocessing.pool.ThreadPool(processes)
+
+    def submit(self,func,*args,**kwds):
+        """Run func(*args,**kwds) in a worker thread.
+
+        This returns an AsyncResult object from which the result can be
+        retrieved using its get() method.
+        """
+        args = (capture_handlers(),func,args,kwds)
+        return self._pool.apply_async(_run_with_handlers,args)
+
+    def imap(self,func,iterable):
+        """Lazily invoke the given function on each item in a worker thread.
+
+        The results are yielded in order.
+        """
+        handlers = capture_handlers()
+        tasks = ((handlers,func,(item,),{}) for item in iterable)
+        return self._pool.imap(_call_task,tasks)
+
+    def map(self,func,iterable):
+        """Invoke the given function on each item in a worker thread.
+
+        This returns a list of the results produced by imap().
+        """
+        return list(self.imap(func,iterable))
+
+    def close(self):
+        """Shut down the worker threads, waiting for them to exit."""
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        self.close()
+
+
+def _call_task(task):
+    return _run_with_handlers(*task)
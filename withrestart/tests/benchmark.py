@@ -0,0 +1,861 @@
+"""
+
+  withrestart.tests.benchmark:  benchmarks for withrestart's hot paths
+
+This module measures the cost of the individual operations that make up the
+restart machinery - entering and exiting contexts, invoking functions that
+succeed, dispatching errors to handlers, invoking restarts, and the "retry"
+and "skip" restarts - while varying the depth of the call stack, the number
+of established handlers, the number of suspended generators and the number
+of threads.  It also measures the overhead of the hooks provided by the
+"withrestart.monitoring" module.
+
+Run it as a script to print the results as JSON, and to compare them against
+a baseline saved from an earlier run.  Timings depend on the machine, so no
+baseline is shipped; save one before making changes and compare against it
+on the same machine afterwards:
+
+    python -m withrestart.tests.benchmark --save baseline.json
+    ... hack hack hack ...
+    python -m withrestart.tests.benchmark --baseline baseline.json
+
+Each result is the best time per operation, in seconds, over several runs.
+The memory used by each kind of established context is also reported, in
+bytes per context, along with the peak RSS of a storm of errors raised from
+frames holding large buffers, with and without "lazy_tracebacks" enabled.
+When comparing against a baseline, any result that is slower or larger by
+more than the given tolerance is reported and the script exits with a
+non-zero status.
+
+"""
+
+from __future__ import with_statement
+
+import sys
+import json
+import optparse
+import threading
+from timeit import default_timer
+
+import withrestart
+from withrestart import *
+
+
+def _at_depth(depth,func,*args):
+    """Call func(*args) from 'depth' additional frames down the stack."""
+    if depth <= 0:
+        return func(*args)
+    return _at_depth(depth-1,func,*args)
+
+
+def _fail_on_seven(v):
+    if v == 7:
+        raise ValueError(v)
+    return v
+
+
+def bench_enter_exit(number,depth):
+    """Enter and exit a RestartSuite context."""
+    def loop():
+        start = default_timer()
+        for _ in xrange(number):
+            with restarts(use_value):
+                pass
+        return default_timer() - start
+    with restarts(skip):
+        return _at_depth(depth,loop)
+
+
+_SKIP_OR_USE_VALUE = FrozenRestartSuite(skip,use_value)
+
+def bench_enter_exit_frozen(number,depth):
+    """Enter and exit a RestartSuite built from a FrozenRestartSuite."""
+    def loop():
+        start = default_timer()
+        for _ in xrange(number):
+            with _SKIP_OR_USE_VALUE:
+                pass
+        return default_timer() - start
+    with restarts(skip):
+        return _at_depth(depth,loop)
+
+
+def bench_enter_exit_unfrozen(number,depth):
+    """Enter and exit a RestartSuite built from scratch each time."""
+    def loop():
+        start = default_timer()
+        for _ in xrange(number):
+            with restarts(skip,use_value):
+                pass
+        return default_timer() - start
+    with restarts(skip):
+        return _at_depth(depth,loop)
+
+
+def bench_enter_exit_handler(number,depth):
+    """Enter and exit a Handler context."""
+    def loop():
+        start = default_timer()
+        for _ in xrange(number):
+            with Handler(ValueError,"use_value",0):
+                pass
+        return default_timer() - start
+    with Handler(TypeError,"skip"):
+        return _at_depth(depth,loop)
+
+
+def bench_invoke_success(number,depth):
+    """Invoke a function that succeeds, via RestartSuite.__call__."""
+    def loop():
+        with restarts(use_value) as invoke:
+            start = default_timer()
+            for _ in xrange(number):
+                invoke(_fail_on_seven,1)
+            return default_timer() - start
+    return _at_depth(depth,loop)
+
+
+def bench_dispatch(number,handlers):
+    """Find the handlers for an error with many handlers established."""
+    def loop():
+        err = ValueError(7)
+        start = default_timer()
+        for _ in xrange(number):
+            find_handlers(err)
+        return default_timer() - start
+    return _with_handlers(handlers,loop)
+
+
+def bench_suite_dispatch(number,handlers):
+    """Recover from an error using a suite with many handlers in it.
+
+    Only the last handler in the suite matches the error.
+    """
+    suite = HandlerSuite(*[(KeyError,"skip")] * (handlers - 1))
+    suite.add_handler(Handler(ValueError,"use_value",0))
+    def loop():
+        with restarts(use_value) as invoke:
+            start = default_timer()
+            for _ in xrange(number):
+                invoke(_fail_on_seven,7)
+            return default_timer() - start
+    with suite:
+        return loop()
+
+
+def _with_handlers(nhandlers,func):
+    """Call func() with 'nhandlers' handlers established."""
+    if nhandlers <= 1:
+        with Handler(ValueError,"use_value",0):
+            return func()
+    with Handler(KeyError,"skip"):
+        return _with_handlers(nhandlers-1,func)
+
+
+def bench_use_value(number,depth):
+    """Recover from an error by invoking the "use_value" restart."""
+    def loop():
+        with restarts(use_value) as invoke:
+            start = default_timer()
+            for _ in xrange(number):
+                invoke(_fail_on_seven,7)
+            return default_timer() - start
+    with Handler(ValueError,"use_value",0):
+        return _at_depth(depth,loop)
+
+
+def _error_on_seven(v,*restarts):
+    if v == 7:
+        return error(ValueError(v),*restarts)
+    return v
+
+
+def bench_signal(number,depth):
+    """Recover from an error "depth" frames down using "use_value".
+
+    The error is signalled with a local "use_value" restart, so the stack
+    is not unwound at all.
+    """
+    with Handler(ValueError,"use_value",0):
+        with restarts(use_value) as invoke:
+            start = default_timer()
+            for _ in xrange(number):
+                invoke(_at_depth,depth,_error_on_seven,7,use_value)
+            return default_timer() - start
+
+
+def bench_signal_unwind(number,depth):
+    """Recover from an error "depth" frames down using "use_value".
+
+    The error is signalled without local restarts, so control must be
+    transferred to the "use_value" restart by unwinding the stack.
+    """
+    with Handler(ValueError,"use_value",0):
+        with restarts(use_value) as invoke:
+            start = default_timer()
+            for _ in xrange(number):
+                invoke(_at_depth,depth,_error_on_seven,7)
+            return default_timer() - start
+
+
+def bench_raise_unwind(number,depth):
+    """Recover from an error "depth" frames down using "use_value".
+
+    The error is raised as usual, so the stack must be unwound before the
+    handlers can be run.  This is the baseline for the signal benchmarks.
+    """
+    with Handler(ValueError,"use_value",0):
+        with restarts(use_value) as invoke:
+            start = default_timer()
+            for _ in xrange(number):
+                invoke(_at_depth,depth,_fail_on_seven,7)
+            return default_timer() - start
+
+
+class _Progress(object):
+    pass
+
+
+def bench_call(number,handlers):
+    """Call an empty function, as a baseline for the notify benchmarks."""
+    def noop(condition):
+        pass
+    def loop():
+        condition = _Progress()
+        start = default_timer()
+        for _ in xrange(number):
+            noop(condition)
+        return default_timer() - start
+    return _with_handlers(handlers,loop)
+
+
+def bench_notify(number,handlers):
+    """Notify a condition for which no handler could possibly match."""
+    def loop():
+        condition = _Progress()
+        start = default_timer()
+        for _ in xrange(number):
+            notify(condition)
+        return default_timer() - start
+    return _with_handlers(handlers,loop)
+
+
+def bench_notify_handled(number,handlers):
+    """Notify a condition which is handled by the outermost handler."""
+    def record(condition):
+        pass
+    def loop():
+        condition = _Progress()
+        start = default_timer()
+        for _ in xrange(number):
+            notify(condition)
+        return default_timer() - start
+    with Handler(_Progress,record):
+        return _with_handlers(handlers,loop)
+
+
+def bench_retry(number,depth):
+    """Recover from an error by invoking the "retry" restart."""
+    state = [False]
+    def fail_every_other():
+        state[0] = not state[0]
+        if state[0]:
+            raise ValueError
+        return 1
+    def loop():
+        with restarts(retry) as invoke:
+            start = default_timer()
+            for _ in xrange(number):
+                invoke(fail_every_other)
+            return default_timer() - start
+    with Handler(ValueError,"retry"):
+        return _at_depth(depth,loop)
+
+
+def bench_skip(number,depth):
+    """Recover from an error by invoking the "skip" restart."""
+    def loop():
+        start = default_timer()
+        for _ in xrange(number):
+            with restarts(skip) as invoke:
+                invoke(_fail_on_seven,7)
+        return default_timer() - start
+    with Handler(ValueError,"skip"):
+        return _at_depth(depth,loop)
+
+
+def _fail_every(n):
+    def calculate(i):
+        if i % n == 0:
+            raise ValueError(i)
+        return i
+    return calculate
+
+
+def bench_map(number,fail_every):
+    """Skip failed items from a batch using RestartSuite.imap."""
+    calculate = _fail_every(fail_every)
+    with Handler(ValueError,"skip"):
+        with restarts(skip,use_value) as invoke:
+            start = default_timer()
+            for _ in invoke.imap(calculate,xrange(number)):
+                pass
+            return default_timer() - start
+
+
+def bench_map_loop(number,fail_every):
+    """Skip failed items from a batch with a RestartSuite per item."""
+    calculate = _fail_every(fail_every)
+    with Handler(ValueError,"skip"):
+        start = default_timer()
+        for i in xrange(number):
+            with restarts(skip,use_value) as invoke:
+                invoke(calculate,i)
+        return default_timer() - start
+
+
+def bench_pool(number,processes):
+    """Recover from errors raised in a ProcessPool using "use_value".
+
+    Every item fails, so this measures the round-trip latency of shipping
+    an error to the parent's handlers and the decision back to the worker.
+    """
+    from withrestart.pool import ProcessPool
+    with ProcessPool(processes) as pool:
+        with Handler(ValueError,"use_value",0):
+            start = default_timer()
+            for _ in pool.imap(_fail_on_seven,[7]*number,(use_value,)):
+                pass
+            return default_timer() - start
+
+
+def _use_value_on_seven(v):
+    with restarts(use_value) as invoke:
+        return invoke(_fail_on_seven,v)
+
+
+def bench_thread_pool(number,threads):
+    """Recover from errors in a ThreadPool using the submitter's handlers."""
+    from withrestart.pool import ThreadPool
+    with ThreadPool(threads) as pool:
+        with Handler(ValueError,"use_value",0):
+            start = default_timer()
+            for _ in pool.imap(_use_value_on_seven,[7]*number):
+                pass
+            return default_timer() - start
+
+
+def bench_capture(number,handlers):
+    """Capture the established handlers, as done when submitting work."""
+    def loop():
+        start = default_timer()
+        for _ in xrange(number):
+            capture_handlers()
+        return default_timer() - start
+    return _with_handlers(handlers,loop)
+
+
+def bench_capture_context(number,handlers):
+    """Capture the established restarts and handlers."""
+    def loop():
+        with restarts(use_value):
+            start = default_timer()
+            for _ in xrange(number):
+                capture_context()
+            return default_timer() - start
+    return _with_handlers(handlers,loop)
+
+
+def bench_run_in_context(number,handlers):
+    """Recover from an error using "use_value" from a captured context."""
+    def capture():
+        with restarts(use_value):
+            return capture_context()
+    snapshot = _with_handlers(handlers,capture)
+    start = default_timer()
+    for _ in xrange(number):
+        run_in_context(snapshot,invoke,_fail_on_seven,7)
+    return default_timer() - start
+
+
+def bench_suspended(number,generators):
+    """Look up a restart while generators are suspended inside contexts."""
+    def suspended():
+        with restarts(skip,use_value):
+            yield None
+    gens = [suspended() for _ in xrange(generators)]
+    try:
+        for g in gens:
+            g.next()
+        with restarts(use_value):
+            start = default_timer()
+            for _ in xrange(number):
+                find_restart("use_value")
+            return default_timer() - start
+    finally:
+        for g in gens:
+            g.close()
+
+
+def _pipeline_stage(items):
+    for item in items:
+        with restarts(skip,use_value) as invoke:
+            yield invoke(_fail_on_seven,item)
+
+
+def bench_pipeline(number,stages):
+    """Pull items through a pipeline of generators, each in a RestartSuite.
+
+    Every tenth item fails in the innermost stage and is recovered using
+    "use_value" by a handler established by the consumer.
+    """
+    items = _pipeline(_pipeline_stage,number,stages)
+    with Handler(ValueError,"use_value",0):
+        start = default_timer()
+        for _ in items:
+            pass
+        return default_timer() - start
+
+
+_scoped_pipeline_stage = scoped_generator(_pipeline_stage)
+
+def bench_scoped_pipeline(number,stages):
+    """Pull items through a pipeline of ScopedGenerators.
+
+    This is the same as the "pipeline" benchmark, but each stage swaps its
+    restarts in and out as it is resumed and suspended.
+    """
+    items = _pipeline(_scoped_pipeline_stage,number,stages)
+    with Handler(ValueError,"use_value",0):
+        start = default_timer()
+        for _ in items:
+            pass
+        return default_timer() - start
+
+
+def _pipeline(stage,number,stages):
+    items = (i % 10 + 3 for i in xrange(number))
+    for _ in xrange(stages):
+        items = stage(items)
+    return items
+
+
+def bench_scoped_suspended(number,generators):
+    """Look up a restart while ScopedGenerators are suspended in contexts."""
+    @scoped_generator
+    def suspended():
+        with restarts(skip,use_value):
+            yield None
+    gens = [suspended() for _ in xrange(generators)]
+    try:
+        for g in gens:
+            g.next()
+        with restarts(use_value):
+            start = default_timer()
+            for _ in xrange(number):
+                find_restart("use_value")
+            return default_timer() - start
+    finally:
+        for g in gens:
+            g.close()
+
+
+def _diagnose(err):
+    #  Stand-in for an expensive investigation of the error.
+    total = 0
+    for i in xrange(1000):
+        total += i
+    raise InvokeRestart("use_value",total)
+
+
+def _fail_from(source):
+    raise ValueError("failed",source)
+
+
+def _error_storm(number,keys,handler):
+    with Handler(ValueError,handler):
+        start = default_timer()
+        for i in xrange(number):
+            with restarts(use_value) as invoke:
+                invoke(_fail_from,i % keys)
+        return default_timer() - start
+
+
+def bench_error_storm(number,keys):
+    """Recover from a storm of errors with an expensive handler.
+
+    The errors come from "keys" different sources, in rotation.
+    """
+    return _error_storm(number,keys,_diagnose)
+
+
+def bench_cached_error_storm(number,keys):
+    """Recover from a storm of errors with a cached expensive handler.
+
+    This is the same as the "error_storm" benchmark, but the handler's
+    decisions are cached by a DecisionCache keyed on the source of the error.
+    """
+    from withrestart.policies import DecisionCache
+    cache = DecisionCache(_diagnose,key=lambda e: e.args[1])
+    return _error_storm(number,keys,cache)
+
+
+def bench_threads(number,threads):
+    """Recover from errors using "use_value" in several threads at once."""
+    ready = threading.Event()
+    times = []
+    def worker():
+        with Handler(ValueError,"use_value",0):
+            with restarts(use_value) as invoke:
+                ready.wait()
+                start = default_timer()
+                for _ in xrange(number):
+                    invoke(_fail_on_seven,7)
+                times.append(default_timer() - start)
+    workers = [threading.Thread(target=worker) for _ in xrange(threads)]
+    for t in workers:
+        t.start()
+    ready.set()
+    for t in workers:
+        t.join()
+    #  Report wall-clock time per operation across all the threads.  If the
+    #  threads ran in parallel this would fall as threads were added; it
+    #  stays roughly constant while the GIL serialises their work.
+    return max(times) / threads
+
+
+def bench_hooks(number,hooks):
+    """Recover from errors using "use_value" with monitoring hooks active.
+
+    With zero hooks this should cost exactly the same as bench_use_value,
+    since the monitoring module only instruments withrestart while at least
+    one callback is registered.
+    """
+    from withrestart import monitoring
+    def callback(event,target,error,start,duration):
+        pass
+    for _ in xrange(hooks):
+        for event in monitoring.EVENTS:
+            monitoring.register(event,callback)
+    try:
+        return bench_use_value(number,1)
+    finally:
+        for _ in xrange(hooks):
+            for event in monitoring.EVENTS:
+                monitoring.unregister(event,callback)
+
+
+def bench_hotspots(number,enabled):
+    """Recover from errors using "use_value" with the hot-spot profiler.
+
+    With the profiler disabled this should cost the same as bench_use_value.
+    """
+    from withrestart import hotspots
+    if enabled:
+        hotspots.enable(hotspots.HotspotProfiler())
+    try:
+        return bench_use_value(number,1)
+    finally:
+        hotspots.disable()
+
+
+def bench_event_log(number,enabled):
+    """Recover from errors using "use_value" while logging recovery actions.
+
+    This measures the cost to the program of buffering the records; they
+    are written out by a background thread.
+    """
+    import os
+    import shutil
+    import tempfile
+    from withrestart.eventlog import EventLog
+    if not enabled:
+        return bench_use_value(number,1)
+    tempdir = tempfile.mkdtemp()
+    try:
+        with EventLog(os.path.join(tempdir,"recovery.log")):
+            return bench_use_value(number,1)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def _deep_sizeof(obj,seen):
+    """Get the size of an object and the containers and withrestart objects
+    it refers to.  Shared objects such as functions and strings are not
+    included, nor is anything that has been seen before.
+    """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj,(list,tuple)):
+        children = obj
+    elif isinstance(obj,dict):
+        children = obj.values()
+    elif type(obj).__module__.startswith("withrestart"):
+        children = []
+        for cls in type(obj).__mro__:
+            for name in cls.__dict__.get("__slots__",()):
+                if hasattr(obj,name):
+                    children.append(getattr(obj,name))
+        try:
+            size += sys.getsizeof(obj.__dict__)
+            children.extend(obj.__dict__.values())
+        except AttributeError:
+            pass
+    else:
+        return size
+    for child in children:
+        size += _deep_sizeof(child,seen)
+    return size
+
+
+def measure_memory():
+    """Measure the memory used by various established contexts, in bytes.
+
+    This includes the context object itself, the objects it contains, and
+    the entry it occupies on the relevant stack.
+    """
+    def sizeof_context(context,stack):
+        with context as result:
+            seen = set([id(context.__class__)])
+            size = _deep_sizeof(result,seen)
+            #  Account for the stack entry, but not its neighbours.
+            entry = getattr(stack,"_get_stack",None)
+            if entry is not None:
+                entry = entry().top
+            else:
+                entry = stack._local.top
+            seen.add(id(entry.next))
+            seen.add(id(entry.frame))
+            size += _deep_sizeof(entry,seen)
+            return size
+    def sizeof_signal(restart):
+        try:
+            Restart(restart).invoke()
+        except ControlFlowException, e:
+            return _deep_sizeof(e,set())
+    return {
+        "restarts[skip,use_value]": sizeof_context(
+                restarts(skip,use_value),withrestart._cur_restarts),
+        "Restart[use_value]": sizeof_context(
+                Restart(use_value),withrestart._cur_restarts),
+        "Handler[use_value]": sizeof_context(
+                Handler(ValueError,"use_value",0),withrestart._cur_handlers),
+        "handlers[2]": sizeof_context(
+                handlers((ValueError,"skip"),(TypeError,"skip")),
+                withrestart._cur_handlers),
+        "signal[skip]": sizeof_signal(skip),
+        "signal[retry]": sizeof_signal(retry),
+    }
+
+
+def _parse_chunk(size):
+    """Parse a chunk of input using a large buffer, and fail."""
+    buf = bytearray(size)
+    raise ValueError(len(buf))
+
+
+def _peak_rss_worker(engine,lazy,size=16*1024*1024,errors=10):
+    """Recover from errors raised by frames holding large buffers.
+
+    Each error is recovered by a restart that allocates a buffer of its own.
+    Without lazy tracebacks the failed frame's buffer is still alive while
+    the restart runs, and until the cyclic garbage collector breaks the
+    cycle between the traceback and the frame holding it.  This prints the
+    peak RSS of the process, in bytes, and is run in a fresh interpreter by
+    measure_peak_rss().
+    """
+    import resource
+    withrestart.set_callstack_engine(engine)
+    withrestart.lazy_tracebacks = lazy
+    def fallback():
+        return len(bytearray(size))
+    with Handler(ValueError,"fallback"):
+        with restarts(fallback) as invoke:
+            for _ in xrange(errors):
+                invoke(_parse_chunk,size)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak *= 1024
+    print peak
+
+
+def measure_peak_rss():
+    """Measure the peak RSS of an error storm, with and without lazy
+    tracebacks, in bytes.
+
+    Each measurement is made in a fresh interpreter, since the peak RSS of
+    a process can never go down.  Nothing is measured on platforms without
+    the resource module.
+    """
+    import os
+    import subprocess
+    try:
+        import resource
+    except ImportError:
+        return {}
+    env = dict(os.environ)
+    path = os.path.dirname(os.path.dirname(os.path.abspath(
+                withrestart.__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None,
+                                               (path,env.get("PYTHONPATH"))))
+    from withrestart.callstack import ENGINES
+    for (engine,cls) in ENGINES.iteritems():
+        if type(withrestart._cur_restarts) is cls:
+            break
+    results = {}
+    for lazy in (0,1):
+        code = "from withrestart.tests.benchmark import _peak_rss_worker; " \
+               "_peak_rss_worker(%r,%d)" % (engine,lazy)
+        proc = subprocess.Popen([sys.executable,"-c",code],env=env,
+                                stdout=subprocess.PIPE)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise RuntimeError("peak RSS measurement failed")
+        key = "peak_rss[lazy_tracebacks=%d]" % (lazy,)
+        results[key] = int(output)
+    return results
+
+
+#  The benchmarks to run, as (name,function,parameter,values) tuples.
+BENCHMARKS = [
+    ("enter_exit",bench_enter_exit,"depth",(1,100)),
+    ("enter_exit_frozen",bench_enter_exit_frozen,"depth",(1,)),
+    ("enter_exit_unfrozen",bench_enter_exit_unfrozen,"depth",(1,)),
+    ("enter_exit_handler",bench_enter_exit_handler,"depth",(1,100)),
+    ("invoke_success",bench_invoke_success,"depth",(1,100)),
+    ("dispatch",bench_dispatch,"handlers",(1,10,100)),
+    ("suite_dispatch",bench_suite_dispatch,"handlers",(1,10,100)),
+    ("use_value",bench_use_value,"depth",(1,100)),
+    ("signal",bench_signal,"depth",(1,100)),
+    ("signal_unwind",bench_signal_unwind,"depth",(1,100)),
+    ("raise_unwind",bench_raise_unwind,"depth",(1,100)),
+    ("call",bench_call,"handlers",(1,100)),
+    ("notify",bench_notify,"handlers",(1,100)),
+    ("notify_handled",bench_notify_handled,"handlers",(1,100)),
+    ("retry",bench_retry,"depth",(1,100)),
+    ("skip",bench_skip,"depth",(1,100)),
+    ("map",bench_map,"fail_every",(10,1000)),
+    ("map_loop",bench_map_loop,"fail_every",(10,1000)),
+    ("suspended",bench_suspended,"generators",(0,10,100)),
+    ("scoped_suspended",bench_scoped_suspended,"generators",(0,10,100)),
+    ("pipeline",bench_pipeline,"stages",(1,10,100)),
+    ("scoped_pipeline",bench_scoped_pipeline,"stages",(1,10,100)),
+    ("pool",bench_pool,"processes",(1,2)),
+    ("thread_pool",bench_thread_pool,"threads",(1,4,16,64)),
+    ("capture",bench_capture,"handlers",(1,100)),
+    ("capture_context",bench_capture_context,"handlers",(1,100)),
+    ("run_in_context",bench_run_in_context,"handlers",(1,100)),
+    ("error_storm",bench_error_storm,"keys",(1,100)),
+    ("cached_error_storm",bench_cached_error_storm,"keys",(1,100)),
+    ("threads",bench_threads,"threads",(1,4,16)),
+    ("hooks",bench_hooks,"hooks",(0,1)),
+    ("hotspots",bench_hotspots,"enabled",(0,1)),
+    ("event_log",bench_event_log,"enabled",(0,1)),
+]
+
+
+#  Benchmarks that start processes or many threads, which the unit tests
+#  leave out to keep the test run short.
+SLOW_BENCHMARKS = ("pool","thread_pool","threads",)
+
+
+def run(number=1000,repeat=3,names=None,peak_rss=True):
+    """Run the benchmarks, returning a dict of results.
+
+    Each result is keyed by "<name>[<param>=<value>]" and gives the best time
+    per operation, in seconds, over 'repeat' runs of 'number' operations.
+    If 'names' is given, only benchmarks with those names are run.  If
+    'peak_rss' is false, the peak RSS measurements are not made.
+    """
+    results = {}
+    for (name,func,param,values) in BENCHMARKS:
+        if names and name not in names:
+            continue
+        for value in values:
+            key = "%s[%s=%s]" % (name,param,value)
+            best = min(func(number,value) for _ in xrange(repeat))
+            results[key] = best / number
+    memory = measure_memory()
+    if peak_rss:
+        memory.update(measure_peak_rss())
+    return {
+        "python": sys.version.split()[0],
+        "version": withrestart.__version__,
+        "engine": type(withrestart._cur_restarts).__name__,
+        "results": results,
+        "memory": memory,
+    }
+
+
+def compare(results,baseline,tolerance=0.25):
+    """Compare benchmark results against a baseline.
+
+    This returns a list of (key,old,new) tuples for each result that is
+    slower, or uses more memory, than in the baseline by more than the
+    given fractional tolerance.
+    """
+    regressions = []
+    for section in ("results","memory"):
+        old_results = baseline.get(section,{})
+        for (key,new) in sorted(results.get(section,{}).iteritems()):
+            try:
+                old = old_results[key]
+            except KeyError:
+                continue
+            if new > old * (1 + tolerance):
+                regressions.append((key,old,new))
+    return regressions
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-n","--number",type="int",default=1000,
+                      help="number of operations per run")
+    parser.add_option("-r","--repeat",type="int",default=3,
+                      help="number of runs for each benchmark")
+    parser.add_option("-b","--benchmark",action="append",dest="names",
+                      help="run only the named benchmark (may be repeated)")
+    parser.add_option("-e","--engine",
+                      help="CallStack engine to use for the benchmarks")
+    parser.add_option("--baseline",
+                      help="compare results against this baseline file")
+    parser.add_option("--tolerance",type="float",default=0.25,
+                      help="allowed fractional slowdown from the baseline")
+    parser.add_option("--save",
+                      help="save results to this file for use as a baseline")
+    (opts,args) = parser.parse_args(argv)
+    if opts.engine is not None:
+        withrestart.set_callstack_engine(opts.engine)
+    results = run(opts.number,opts.repeat,opts.names)
+    json.dump(results,sys.stdout,indent=2,sort_keys=True)
+    sys.stdout.write("\n")
+    if opts.save is not None:
+        f = open(opts.save,"w")
+        try:
+            json.dump(results,f,indent=2,sort_keys=True)
+        finally:
+            f.close()
+    if opts.baseline is not None:
+        f = open(opts.baseline,"r")
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        regressions = compare(results,baseline,opts.tolerance)
+        for (key,old,new) in regressions:
+            if key in results["memory"]:
+                sys.stderr.write("REGRESSION %s: %d bytes -> %d bytes\n"
+                                 % (key,old,new))
+            else:
+                sys.stderr.write("REGRESSION %s: %.3fus -> %.3fus (x%.2f)\n"
+                                 % (key,old*1e6,new*1e6,new/old))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
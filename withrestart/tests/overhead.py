@@ -6,6 +6,12 @@
 This module provides two simple functions "test_tryexcept" and "test_restart"
 that are used to compare the overhead of a restart-based approach to a bare
 try-except clause.
+
+It also provides the functions "test_lookup" and "test_many_restarts", which
+are used to measure the cost of looking up restarts and handlers from various
+depths in the call stack and with various numbers of restarts established.
+
+For more thorough measurements see the "withrestart.tests.benchmark" module.
 """
 
 from withrestart import *
@@ -39,3 +45,29 @@ def test_restart(input,output):
     assert caller(input) == output
 
 
+def test_lookup(depth,count=100):
+    def endpoint():
+        for _ in xrange(count):
+            find_restart("use_value")
+            find_handlers(ValueError())
+    def recurse(n):
+        if n <= 0:
+            return endpoint()
+        return recurse(n-1)
+    with Handler(ValueError,"use_value",0):
+        with restarts(use_value):
+            recurse(depth)
+
+
+def test_many_restarts(nsuites,count=100):
+    def establish(n):
+        if n <= 0:
+            for _ in xrange(count):
+                assert find_restart("use_value") is not None
+                assert find_restart(skip) is not None
+        else:
+            with restarts(raise_error,retry):
+                establish(n-1)
+    with restarts(skip,use_value):
+        establish(nsuites-1)
+